@@ -5,6 +5,7 @@ from flask import Flask
 
 from config import config
 
+from .sqlite import close_all as close_sqlite_connections
 from .views.admin import admin
 from .views.chains import chains
 from .views.export_job import export_job
@@ -40,4 +41,6 @@ def create_app(config_name: str = "development", instance_path: Optional[str] =
     app.register_blueprint(admin, url_prefix="/admin")
     app.register_blueprint(export_job)
 
+    app.teardown_appcontext(close_sqlite_connections)
+
     return app
@@ -21,6 +21,8 @@ from .util import prettyp
 if TYPE_CHECKING:
     from .user import User
 
+SQLite.register_table("rates", ("id", "timestamp", "rate"))
+
 
 class CoinGeckoApiFailureNoResponse(Exception):
     pass
@@ -353,10 +355,9 @@ class CoinGecko:
 
             prices = data["prices"]
 
-            for ts, price in prices:
-                ts = int(ts / 1000)
-                db.insert_kw("rates", values=[cg_id, ts, price], ignore=True)
-                rate_table[ts] = price
+            rate_rows = [(cg_id, int(ts / 1000), price) for ts, price in prices]
+            db.insert_many("rates", None, rate_rows, ignore=True)
+            rate_table.update((ts, price) for _cg_id, ts, price in rate_rows)
 
             # merge ranges
             current_app.logger.debug(
@@ -377,39 +378,34 @@ class CoinGecko:
     def create_tables(self, drop: bool = False) -> None:
         db = SQLite("db")
         try:
-            db.execute("BEGIN TRANSACTION")
-
-            if drop:
-                db.execute("DROP TABLE IF EXISTS symbols")
+            with db.transaction():
+                if drop:
+                    db.execute("DROP TABLE IF EXISTS symbols")
 
-            db.execute(
-                "CREATE TABLE IF NOT EXISTS symbols (id PRIMARY KEY, symbol TEXT, name TEXT, "
-                "stablecoin INTEGER, wrapped_token INTEGER, bridged_token INTEGER, "
-                "market_cap INTEGER, principal INTEGER, status INTEGER)"
-            )
-
-            # Create platforms table with IF NOT EXISTS when not dropping
-            if drop:
-                db.execute("DROP TABLE IF EXISTS platforms")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS symbols (id PRIMARY KEY, symbol TEXT, name TEXT, "
+                    "stablecoin INTEGER, wrapped_token INTEGER, bridged_token INTEGER, "
+                    "market_cap INTEGER, principal INTEGER, status INTEGER)"
+                )
 
-            db.execute(
-                "CREATE TABLE IF NOT EXISTS platforms (id TEXT, platform TEXT, address TEXT)"
-            )
+                # Create platforms table with IF NOT EXISTS when not dropping
+                if drop:
+                    db.execute("DROP TABLE IF EXISTS platforms")
 
-            # Create indexes with IF NOT EXISTS when not dropping
-            if drop:
-                db.execute("DROP INDEX IF EXISTS platforms_i1")
-                db.execute("DROP INDEX IF EXISTS platforms_i2")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS platforms (id TEXT, platform TEXT, address TEXT)"
+                )
 
-            db.execute("CREATE INDEX IF NOT EXISTS platforms_i1 ON platforms (id)")
-            db.execute(
-                "CREATE UNIQUE INDEX IF NOT EXISTS platforms_i2 ON platforms (platform, address)"
-            )
+                # Create indexes with IF NOT EXISTS when not dropping
+                if drop:
+                    db.execute("DROP INDEX IF EXISTS platforms_i1")
+                    db.execute("DROP INDEX IF EXISTS platforms_i2")
 
-            db.execute("COMMIT")
-        except sqlite3.Error as e:
-            db.execute("ROLLBACK")
-            raise e
+                db.execute("CREATE INDEX IF NOT EXISTS platforms_i1 ON platforms (id)")
+                db.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS platforms_i2 "
+                    "ON platforms (platform, address)"
+                )
         finally:
             db.disconnect()
 
@@ -435,61 +431,75 @@ class CoinGecko:
             bridged_tokens = [coin["id"] for coin in self.api.coins_markets("bridged-tokens")]
             highest_caps = self._find_highest_market_cap(coins, id_to_market_cap)
 
-            db.execute("BEGIN TRANSACTION")
-
-            # Delete all existing platform entries
-            db.execute("DELETE FROM platforms")
-
-            # First mark all existing symbols as delisted (status=2) and reset principal flag
-            db.execute(
-                "UPDATE symbols SET principal = 0, status = ?",
-                [CoinGeckoCoinStatus.DELISTED.value],
+            # Upsert in place rather than INSERT OR REPLACE, which deletes then re-inserts the row
+            symbol_columns = (
+                "id",
+                "symbol",
+                "name",
+                "stablecoin",
+                "wrapped_token",
+                "bridged_token",
+                "market_cap",
+                "principal",
+                "status",
+            )
+            symbol_upsert = (
+                f"INSERT INTO symbols ({', '.join(symbol_columns)}) "
+                f"VALUES ({', '.join('?' * len(symbol_columns))}) "
+                "ON CONFLICT (id) DO UPDATE SET "
+                + ", ".join(f"{col} = excluded.{col}" for col in symbol_columns[1:])
             )
 
-            # Process and insert all coins
-            for coin in coins:
-                cg_id = coin["id"]
-                is_stablecoin = 1 if cg_id in stablecoins else 0
-                is_wrapped_token = 1 if cg_id in wrapped_tokens else 0
-                is_bridged_token = 1 if cg_id in bridged_tokens else 0
-                is_principal = (
-                    1
-                    if cg_id in stablecoins
-                    or cg_id in wrapped_tokens
-                    or cg_id in bridged_tokens
-                    or cg_id in highest_caps
-                    else 0
-                )
+            with db.transaction("IMMEDIATE"):
+                # Delete all existing platform entries
+                db.execute("DELETE FROM platforms")
 
+                # First mark all existing symbols as delisted (status=2) and reset principal flag
                 db.execute(
-                    "INSERT OR REPLACE INTO symbols (id, symbol, name, stablecoin, wrapped_token, "
-                    "bridged_token, market_cap, principal, status) "
-                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    [
-                        cg_id,
-                        coin["symbol"],
-                        coin["name"],
-                        is_stablecoin,
-                        is_wrapped_token,
-                        is_bridged_token,
-                        id_to_market_cap.get(cg_id, 0),
-                        is_principal,
-                        coin["status"],
-                    ],
+                    "UPDATE symbols SET principal = 0, status = ?",
+                    [CoinGeckoCoinStatus.DELISTED.value],
                 )
 
-                platform_rows = []
-                for platform, address in coin["platforms"].items():
-                    if platform and address:
-                        platform_rows.append((cg_id, platform, address))
+                # Process and insert all coins
+                for coin in coins:
+                    cg_id = coin["id"]
+                    is_stablecoin = 1 if cg_id in stablecoins else 0
+                    is_wrapped_token = 1 if cg_id in wrapped_tokens else 0
+                    is_bridged_token = 1 if cg_id in bridged_tokens else 0
+                    is_principal = (
+                        1
+                        if cg_id in stablecoins
+                        or cg_id in wrapped_tokens
+                        or cg_id in bridged_tokens
+                        or cg_id in highest_caps
+                        else 0
+                    )
 
-                if platform_rows:
-                    db.execute_many(
-                        "INSERT INTO platforms (id, platform, address) VALUES (?, ?, ?)",
-                        platform_rows,
+                    db.execute(
+                        symbol_upsert,
+                        [
+                            cg_id,
+                            coin["symbol"],
+                            coin["name"],
+                            is_stablecoin,
+                            is_wrapped_token,
+                            is_bridged_token,
+                            id_to_market_cap.get(cg_id, 0),
+                            is_principal,
+                            coin["status"],
+                        ],
                     )
 
-            db.execute("COMMIT")
+                    platform_rows = []
+                    for platform, address in coin["platforms"].items():
+                        if platform and address:
+                            platform_rows.append((cg_id, platform, address))
+
+                    if platform_rows:
+                        db.execute_many(
+                            "INSERT INTO platforms (id, platform, address) VALUES (?, ?, ?)",
+                            platform_rows,
+                        )
 
             # Log statistics
             result = db.select(
@@ -507,12 +517,8 @@ class CoinGecko:
                 f"Updated {len(coins):,} coins with {principal_count:,} principals from CoinGecko"
             )
         except (CoinGeckoApiFailureNoResponse, CoinGeckoApiFailureBadResponse):
-            # Roll back if there was an API issue
-            db.query("ROLLBACK")
             current_app.logger.error("Failed to download CoinGecko symbols")
         except sqlite3.Error as e:
-            # Roll back on specific database or value errors
-            db.query("ROLLBACK")
             current_app.logger.error("Failed to insert CoinGecko symbols, error=%s", str(e))
         finally:
             db.disconnect()
@@ -8,6 +8,8 @@ from flask import current_app
 from .sqlite import SQLite
 from .util import log, log_error, timestamp_to_date
 
+SQLite.register_table("fiat_rates", ("currency", "timestamp", "rate"))
+
 
 class Twelve:
     FIAT_SYMBOLS = {
@@ -116,11 +118,7 @@ class Twelve:
             log("all_db_writes", len(all_db_writes), filename="fiat.txt")
             self.db.disconnect()
             self.db = SQLite("db", do_logging=False, read_only=False)
-            for entry in all_db_writes:
-                self.db.insert_kw(
-                    "fiat_rates", currency=entry[0], timestamp=entry[1], rate=entry[2]
-                )
-            self.db.commit()
+            self.db.insert_many("fiat_rates", None, all_db_writes)
         self.db.disconnect()
 
     def download_rates(self, symbol):
@@ -9,7 +9,6 @@ import traceback
 from collections import defaultdict
 from hashlib import sha256
 
-import base58
 import requests
 from flask import current_app
 from pure25519.basic import decodepoint
@@ -19,6 +18,11 @@ from .imports import Import
 from .transaction import Transaction, Transfer
 from .util import log, log_error, normalize_address
 
+try:
+    from based58 import b58decode, b58encode
+except ImportError:
+    from base58 import b58decode, b58encode
+
 
 class Solana(Chain):
     # order matters, weirdest last
@@ -1409,23 +1413,17 @@ class Solana(Chain):
                         if ua != address:
                             nft_id += " " + contract
                             contract = ua
-                    if contract not in rv:
-                        rv[contract] = {"symbol": symbol, "nft_amounts": {}}
-
-                    rv[contract]["nft_amounts"][nft_id] = amount
+                    nft_entry = rv.setdefault(contract, {"symbol": symbol, "nft_amounts": {}})
+                    nft_entry["nft_amounts"][nft_id] = amount
 
                     # rv[contract][nft_id] = [symbol,amount]
                 else:
                     rv[contract] = {"symbol": symbol, "amount": amount}
 
-            rv = dict(rv)
             WSOL = "So11111111111111111111111111111111111111112"
-            if WSOL in rv:
-                try:
-                    rv["SOL"]["amount"] += rv[WSOL]["amount"]
-                    del rv[WSOL]
-                except:
-                    pass
+            wsol = rv.pop(WSOL, None)
+            if wsol is not None:
+                rv["SOL"]["amount"] += wsol.get("amount", 0)
 
             log("current tokens to store", rv, filename="solana.txt")
             return rv
@@ -1445,21 +1443,21 @@ class Solana(Chain):
 
         assert data[0] == 4
         i = 1
-        source_account = base58.b58encode(bytes(struct.unpack("<" + "B" * 32, data[i : i + 32])))
+        source_account = b58encode(data[i : i + 32])
         i += 32
-        mint_account = base58.b58encode(bytes(struct.unpack("<" + "B" * 32, data[i : i + 32])))
+        mint_account = b58encode(data[i : i + 32])
         i += 32
         name_len = struct.unpack("<I", data[i : i + 4])[0]
         i += 4
-        name = struct.unpack("<" + "B" * name_len, data[i : i + name_len])
+        name = data[i : i + name_len].decode("utf-8").rstrip("\x00")
         i += name_len
         symbol_len = struct.unpack("<I", data[i : i + 4])[0]
         i += 4
-        symbol = struct.unpack("<" + "B" * symbol_len, data[i : i + symbol_len])
+        symbol = data[i : i + symbol_len].decode("utf-8").rstrip("\x00")
         i += symbol_len
         uri_len = struct.unpack("<I", data[i : i + 4])[0]
         i += 4
-        uri = struct.unpack("<" + "B" * uri_len, data[i : i + uri_len])
+        uri = data[i : i + uri_len].decode("utf-8").rstrip("\x00")
         i += uri_len
         fee = struct.unpack("<h", data[i : i + 2])[0]
         i += 2
@@ -1472,7 +1470,7 @@ class Solana(Chain):
             creator_len = struct.unpack("<I", data[i : i + 4])[0]
             i += 4
             for _ in range(creator_len):
-                creator = base58.b58encode(bytes(struct.unpack("<" + "B" * 32, data[i : i + 32])))
+                creator = b58encode(data[i : i + 32])
                 creators.append(creator)
                 i += 32
                 verified.append(data[i])
@@ -1486,9 +1484,9 @@ class Solana(Chain):
             "update_authority": source_account,
             "mint": mint_account,
             "data": {
-                "name": bytes(name).decode("utf-8").strip("\x00"),
-                "symbol": bytes(symbol).decode("utf-8").strip("\x00"),
-                "uri": bytes(uri).decode("utf-8").strip("\x00"),
+                "name": name,
+                "symbol": symbol,
+                "uri": uri,
                 "seller_fee_basis_points": fee,
                 "creators": creators,
                 "verified": verified,
@@ -1610,6 +1608,9 @@ class Solana(Chain):
         if destination.originator is None:
             destination.originator = source.originator
 
+        # Same membership test as the non-strict source.my_address(), without the call per check
+        my_addresses = source.user.all_addresses
+
         for _source_idx, (
             type,
             sub_data,
@@ -1665,11 +1666,11 @@ class Solana(Chain):
                         # Skipping transfer
                         break
                     if fr == c_fr or to == c_to:
-                        if source.my_address(fr) and not source.my_address(c_fr):
+                        if fr in my_addresses and c_fr not in my_addresses:
                             # Updating transfer from address
                             destination.grouping[dest_idx][4] = fr
                             break
-                        if source.my_address(to) and not source.my_address(c_to):
+                        if to in my_addresses and c_to not in my_addresses:
                             # Updating transfer to address
                             destination.grouping[dest_idx][5] = to
                             break
@@ -1698,9 +1699,10 @@ class PublicKey:
     def __init__(self, value):
         """Init PublicKey object."""
         self._key = None
+        self._base58 = None
         if isinstance(value, str):
             try:
-                self._key = base58.b58decode(value)
+                self._key = b58decode(value.encode("ascii"))
             except ValueError as err:
                 raise ValueError("invalid public key input:", value) from err
             if len(self._key) != self.LENGTH:
@@ -1733,7 +1735,9 @@ class PublicKey:
 
     def to_base58(self) -> bytes:
         """Public key in base58."""
-        return base58.b58encode(bytes(self))
+        if self._base58 is None:
+            self._base58 = b58encode(bytes(self))
+        return self._base58
 
     @staticmethod
     def create_with_seed(from_public_key, seed, program_id):
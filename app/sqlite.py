@@ -1,13 +1,93 @@
+import itertools
 import os
 import sqlite3
-import sys
+import threading
 import time
-import traceback
 import warnings
-from typing import Any, List, NotRequired, Optional, TypedDict, Union
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NotRequired,
+    Optional,
+    Sequence,
+    Tuple,
+    TypedDict,
+    Union,
+)
 
 from flask import current_app
 
+# Open SQLite instances on the same database in a thread share one connection, and so one
+# transaction; it is closed when the last of them disconnects. Pool entries are
+# [connection, open instances, transaction() nesting depth]
+_pool = threading.local()
+
+# Bound to statements as-is; anything else goes through SQLite.infer_meaning
+NATIVE_TYPES = (str, bytes, type(None))
+
+
+class SQLiteError(Exception):
+    pass
+
+
+class SQLiteQueryError(SQLiteError):
+    pass
+
+
+def _pooled_connections() -> Dict[Tuple[str, bool], List[Any]]:
+    if not hasattr(_pool, "conns"):
+        _pool.conns = {}
+    return _pool.conns
+
+
+# Built statements, keyed by query shape and shared by all SQLite instances
+_query_cache: Dict[Tuple, str] = {}
+_table_columns: Dict[str, Tuple[str, ...]] = {}
+
+
+def _insert_query(table: str, columns: Tuple[str, ...], error_mode: str) -> str:
+    cache_key = ("insert", table, error_mode, columns)
+    query = _query_cache.get(cache_key)
+    if query is None:
+        query = (
+            f"INSERT OR {error_mode} INTO {table} ({','.join(columns)}) "
+            f"VALUES ({','.join('?' * len(columns))})"
+        )
+        _query_cache[cache_key] = query
+    return query
+
+
+# filterwarnings scans the global filter list, so the filter is only installed once per process
+_sqlite3_deprecations_ignored = False
+
+
+def _ignore_sqlite3_deprecations() -> None:
+    global _sqlite3_deprecations_ignored  # pylint: disable=global-statement
+    if not _sqlite3_deprecations_ignored:
+        warnings.filterwarnings("ignore", category=DeprecationWarning, module="sqlite3")
+        _sqlite3_deprecations_ignored = True
+
+
+def close_all(_exception: Optional[BaseException] = None) -> None:
+    # Safety net at teardown: the last disconnect() already closes and unpools a connection, so
+    # anything left here belongs to instances that were never disconnected. Those instances
+    # keep a closed connection and can't be used afterwards.
+    conns = _pooled_connections()
+    for (db_path, read_only), entry in conns.items():
+        current_app.logger.warning(
+            "SQLite connection to %s (read_only=%s) still held by %s instance(s) at teardown",
+            db_path,
+            read_only,
+            entry[1],
+        )
+        entry[0].close()
+    conns.clear()
+
 
 class CommandList(TypedDict):
     commit: bool
@@ -21,104 +101,156 @@ class SQLite:
         db: str,
         read_only: bool = False,
         do_logging: bool = False,
+        wal: bool = True,
     ):
         if not current_app.debug:
-            warnings.filterwarnings("ignore", category=DeprecationWarning, module="sqlite3")
+            _ignore_sqlite3_deprecations()
 
         self.do_logging = do_logging
         self.do_error_logging = True
         self.db = db
 
         db_path = os.path.join(current_app.instance_path, f"{db}.db")
+        self._pool_key = (db_path, read_only)
+        conns = _pooled_connections()
+        entry = conns.get(self._pool_key)
+        if entry is None:
+            entry = conns[self._pool_key] = [self._connect(db_path, read_only, wal), 0, 0]
+        entry[1] += 1
+        self._entry = entry
+        self._connected = True
+        self.conn = entry[0]
+        self.conn.row_factory = sqlite3.Row
+
+    @staticmethod
+    def _connect(db_path: str, read_only: bool, wal: bool) -> sqlite3.Connection:
         if read_only:
-            self.conn = sqlite3.connect(f"file:{db_path}?mode=ro", timeout=30, uri=True)
+            conn = sqlite3.connect(f"file:{db_path}?mode=ro", timeout=30, uri=True)
+            conn.executescript("PRAGMA query_only=1; PRAGMA mmap_size=268435456;")
+            return conn
+
+        conn = sqlite3.connect(db_path, timeout=30)
+        pragmas = "PRAGMA temp_store=MEMORY; PRAGMA cache_size=-65536; PRAGMA mmap_size=268435456;"
+        if wal:
+            conn.executescript("PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; " + pragmas)
         else:
-            self.conn = sqlite3.connect(db_path, timeout=30)
-        self.conn.row_factory = sqlite3.Row
+            # the journal mode is stored in the file, so switch back databases opened with WAL
+            conn.executescript("PRAGMA journal_mode=DELETE; " + pragmas)
+        return conn
 
-    def _execute_and_log(
-        self, cursor: sqlite3.Cursor, query: str, values: Optional[List] = None
-    ) -> None:
-        tstart = time.time()
-        error = None
+    def _execute_and_log(self, query: str, values: Optional[List] = None) -> sqlite3.Cursor:
+        do_logging = self.do_logging
+        tstart = time.time() if do_logging else 0.0
         try:
-            if values is None:
-                cursor.execute(query)
-            else:
-                cursor.execute(query, values)
-        except sqlite3.Error:
-            error = traceback.format_exc()
-        tend = time.time()
-        if error is not None and self.do_error_logging:
-            current_app.logger.error(
-                "SQL ERROR %s %s VALUES %s ERROR %s", self.db, query, values, error
+            cursor = (
+                self.conn.execute(query) if values is None else self.conn.execute(query, values)
             )
+        except sqlite3.Error as e:
+            if self.do_error_logging:
+                current_app.logger.error(
+                    "SQL ERROR %s %s VALUES %s ERROR %s", self.db, query, values, e
+                )
+            raise SQLiteQueryError(str(e)) from None
 
-        if self.do_logging:
+        if do_logging:
             current_app.logger.debug(
-                "SQL QUERY %s %s VALUES %s TIMING %s", self.db, query, values, str(tend - tstart)
+                "SQL QUERY %s %s VALUES %s TIMING %s",
+                self.db,
+                query,
+                values,
+                str(time.time() - tstart),
             )
-
-        if error:
-            sys.exit(1)
+        return cursor
 
     def disconnect(self) -> None:
-        self.conn.close()
+        if not self._connected:
+            return
+        self._connected = False
+
+        conns = _pooled_connections()
+        entry = conns.get(self._pool_key)
+        if entry is None or entry[0] is not self.conn:
+            # already closed by close_all()
+            return
+
+        entry[1] -= 1
+        if entry[1] == 0:
+            # closing rather than idling lets a deleted or replaced db file be opened afresh
+            self.conn.close()
+            del conns[self._pool_key]
+
+    def _in_transaction_block(self) -> bool:
+        # true inside a transaction() block opened by any instance sharing the connection
+        return self._entry[2] > 0
 
     def commit(self) -> None:
-        self.conn.commit()
+        # inside a transaction() block the commit is left to the outermost block
+        if not self._in_transaction_block():
+            self.conn.commit()
+
+    @contextmanager
+    def transaction(self, mode: str = "DEFERRED") -> Iterator[None]:
+        # Nested blocks join the outermost one rather than nesting BEGIN
+        entry = self._entry
+        own_transaction = not entry[2]
+        if own_transaction:
+            # commit statements run before the block, so a rollback only undoes the block
+            if self.conn.in_transaction:
+                self.conn.commit()
+            self.conn.execute(f"BEGIN {mode}")
+        entry[2] += 1
+        try:
+            yield
+        except BaseException:
+            entry[2] -= 1
+            if own_transaction:
+                self.conn.rollback()
+            raise
+        entry[2] -= 1
+        if own_transaction:
+            self.conn.commit()
 
     def create_table(self, table_name: str, fields: str, drop: bool = True) -> None:
-        c = self.conn.cursor()
         if drop:
             query = f"DROP TABLE IF EXISTS {table_name}"
-            self._execute_and_log(c, query)
+            self._execute_and_log(query)
 
         query = f"CREATE TABLE IF NOT EXISTS {table_name} ({fields})"
-        self._execute_and_log(c, query)
-        self.conn.commit()
+        self._execute_and_log(query)
+        if self.conn.in_transaction:
+            self.commit()
 
     def create_index(
         self, index_name: str, table_name: str, fields: str, unique: bool = False
     ) -> None:
-        c = self.conn.cursor()
-        query = "CREATE "
-        if unique:
-            query += "UNIQUE "
-        query += f"INDEX IF NOT EXISTS {index_name} ON {table_name} ({fields})"
-        self._execute_and_log(c, query)
-        self.conn.commit()
+        unique_str = "UNIQUE " if unique else ""
+        query = f"CREATE {unique_str}INDEX IF NOT EXISTS {index_name} ON {table_name} ({fields})"
+        self._execute_and_log(query)
+        if self.conn.in_transaction:
+            self.commit()
 
     def query(self, q: str, commit: bool = True, value_list: Optional[List[Any]] = None) -> int:
-        c = self.conn.cursor()
-        self._execute_and_log(c, q, value_list)
+        c = self._execute_and_log(q, value_list)
         if commit:
             self.commit()
         return c.rowcount
 
     def execute(self, query: str, value_list: Optional[List[Any]] = None) -> int:
-        c = self.conn.cursor()
         if value_list is not None:
-            c.execute(query, value_list)
-        else:
-            c.execute(query)
-        return c.rowcount
+            return self.conn.execute(query, value_list).rowcount
+        return self.conn.execute(query).rowcount
 
     def execute_many(self, query: str, value_list: List[Any]) -> int:
-        c = self.conn.cursor()
-        c.executemany(query, value_list)
-        return c.rowcount
+        return self.conn.executemany(query, value_list).rowcount
 
-    def infer_meaning(
-        self, value: Any, keyworded: bool = False
-    ) -> Union[str, sqlite3.Binary, None]:
+    def infer_meaning(self, value: Any, keyworded: bool = False) -> Union[str, bytes, None]:
         if isinstance(value, str):
             if keyworded:
                 return "'" + value + "'"
             return value
         if isinstance(value, bytes):
-            return sqlite3.Binary(value)
-        if value in [True, False]:
+            return value
+        if value in (True, False):
             return str(int(value))
         if value is None:
             if keyworded:
@@ -126,10 +258,33 @@ class SQLite:
             return None
         return str(value)
 
+    def _make_typer(self, sample: Any) -> Callable[[Any], Union[str, bytes, None]]:
+        # Resolve the infer_meaning branch once per column from a sample value; values of any
+        # other type in the same column still go through infer_meaning
+        infer_meaning = self.infer_meaning
+        if isinstance(sample, str):
+            return lambda value: value if isinstance(value, str) else infer_meaning(value)
+        if isinstance(sample, bytes):
+            return lambda value: value if isinstance(value, bytes) else infer_meaning(value)
+        if sample is True or sample is False:
+            return lambda value: (
+                "1" if value is True else "0" if value is False else infer_meaning(value)
+            )
+        if sample is None:
+            return lambda value: None if value is None else infer_meaning(value)
+        # exact type match, so bools in an int column still go through infer_meaning, as do
+        # values equal to 0 or 1, which infer_meaning stores as '0'/'1' even for 0.0 and 1.0
+        sample_type = type(sample)
+        return lambda value: (
+            str(value)
+            if type(value) is sample_type  # pylint: disable=unidiomatic-typecheck
+            and value not in (True, False)
+            else infer_meaning(value)
+        )
+
     def insert_kw(self, table: str, **kwargs: Any) -> int:
         column_list = []
-        value_list: List[Union[str, sqlite3.Binary, None]] = []
-        placeholder_list = []
+        value_list: List[Union[str, bytes, None]] = []
         command_list: CommandList = {
             "commit": False,
             "ignore": False,
@@ -145,37 +300,99 @@ class SQLite:
                 command_list["values"] = value
             else:
                 column_list.append(key)
-                value_list.append(self.infer_meaning(value))
-                placeholder_list.append("?")
+                value_list.append(
+                    value if type(value) in NATIVE_TYPES else self.infer_meaning(value)
+                )
 
         error_mode = "REPLACE"
         if command_list["ignore"]:
             error_mode = "IGNORE"
 
         if command_list["values"] is not None:
-            value_list = []
-            for value in list(command_list["values"]):
-                value_list.append(self.infer_meaning(value))
-                placeholder_list.append("?")
-
-            query = f"INSERT OR {error_mode} INTO {table} VALUES ({','.join(placeholder_list)})"
+            value_list = [
+                value if type(value) in NATIVE_TYPES else self.infer_meaning(value)
+                for value in command_list["values"]
+            ]
+            cache_key = ("insert", table, error_mode, len(value_list))
+            query = _query_cache.get(cache_key)
+            if query is None:
+                placeholders = ",".join("?" * len(value_list))
+                query = f"INSERT OR {error_mode} INTO {table} VALUES ({placeholders})"
+                _query_cache[cache_key] = query
         else:
-            query = (
-                f"INSERT OR {error_mode} INTO {table} ({','.join(column_list)}) "
-                f"VALUES ({','.join(placeholder_list)})"
-            )
+            query = _insert_query(table, tuple(column_list), error_mode)
 
         try:
-            c = self.conn.cursor()
-            self._execute_and_log(c, query, value_list)
+            c = self._execute_and_log(query, value_list)
             if command_list["commit"]:
-                self.conn.commit()
+                self.commit()
             return c.rowcount
+        except SQLiteQueryError:
+            if self._in_transaction_block():
+                raise
+            current_app.logger.error(
+                "%s insert_kw failed table %s kwargs %s", self.db, table, kwargs
+            )
+            return 0
         except sqlite3.Error as e:
             current_app.logger.error(
                 "%s insert_kw error %s table %s kwargs %s", self.db, e, table, kwargs
             )
-            sys.exit(1)
+            raise SQLiteError(str(e)) from e
+
+    @staticmethod
+    def register_table(table: str, columns: Sequence[str]) -> None:
+        # Prebuild the full-row INSERT statements; insert_many uses these columns when none
+        # are given
+        _table_columns[table] = tuple(columns)
+        for error_mode in ("REPLACE", "IGNORE"):
+            _insert_query(table, _table_columns[table], error_mode)
+
+    def insert_many(
+        self,
+        table: str,
+        columns: Optional[Sequence[str]],
+        rows: Iterable[Sequence[Any]],
+        ignore: bool = False,
+        chunk_size: int = 10000,
+    ) -> int:
+        error_mode = "IGNORE" if ignore else "REPLACE"
+        query = _insert_query(
+            table, _table_columns[table] if columns is None else tuple(columns), error_mode
+        )
+        row_iter = iter(rows)
+        first_row = next(row_iter, None)
+        if first_row is None:
+            return 0
+        typers = [self._make_typer(value) for value in first_row]
+        converted = (
+            tuple(typer(value) for typer, value in zip(typers, row))
+            for row in itertools.chain([first_row], row_iter)
+        )
+
+        own_transaction = not self.conn.in_transaction
+        rowcount = 0
+        try:
+            if own_transaction:
+                self.conn.execute("BEGIN")
+            while True:
+                chunk = list(itertools.islice(converted, chunk_size))
+                if not chunk:
+                    break
+                rowcount += self.conn.executemany(query, chunk).rowcount
+            if own_transaction:
+                self.conn.commit()
+        except sqlite3.Error as e:
+            if own_transaction:
+                self.conn.rollback()
+            current_app.logger.error("%s insert_many error %s table %s", self.db, e, table)
+            if self._in_transaction_block():
+                raise SQLiteQueryError(str(e)) from None
+            return 0
+
+        if self.do_logging:
+            current_app.logger.debug("SQL INSERT MANY %s %s ROWS %s", self.db, query, rowcount)
+        return rowcount
 
     def update_kw(
         self,
@@ -184,7 +401,7 @@ class SQLite:
         **kwargs: Any,
     ) -> int:
         value_list = []
-        pair_placeholder_list = []
+        column_list = []
         command_list: CommandList = {"commit": False, "ignore": False}
 
         for key, value in kwargs.items():
@@ -193,28 +410,42 @@ class SQLite:
             elif key == "ignore":
                 command_list["ignore"] = value
             else:
-                value_list.append(self.infer_meaning(value))
-                pair_placeholder_list.append(f"{key} = ?")
+                value_list.append(
+                    value if type(value) in NATIVE_TYPES else self.infer_meaning(value)
+                )
+                column_list.append(key)
 
         error_mode = "REPLACE"
         if command_list["ignore"]:
             error_mode = "IGNORE"
 
-        query = f"UPDATE OR {error_mode} {table} SET {','.join(pair_placeholder_list)}"
+        # WHERE clauses usually embed literal values, so only the SET part is cached
+        cache_key = ("update", table, error_mode, tuple(column_list))
+        query = _query_cache.get(cache_key)
+        if query is None:
+            pair_placeholders = ",".join(f"{key} = ?" for key in column_list)
+            query = f"UPDATE OR {error_mode} {table} SET {pair_placeholders}"
+            _query_cache[cache_key] = query
         if where is not None:
             query += f" WHERE {where}"
 
         try:
-            c = self.conn.cursor()
-            self._execute_and_log(c, query, value_list)
+            c = self._execute_and_log(query, value_list)
             if command_list["commit"]:
-                self.conn.commit()
+                self.commit()
             return c.rowcount
+        except SQLiteQueryError:
+            if self._in_transaction_block():
+                raise
+            current_app.logger.error(
+                "%s update_kw failed table %s kwargs %s", self.db, table, kwargs
+            )
+            return 0
         except sqlite3.Error as e:
             current_app.logger.error(
                 "%s update_kw error %s table %s kwargs %s", self.db, e, table, kwargs
             )
-            sys.exit(1)
+            raise SQLiteError(str(e)) from e
 
     def select(
         self,
@@ -222,33 +453,38 @@ class SQLite:
         return_dictionaries: bool = False,
         id_col: Optional[str] = None,
         raw: bool = False,
+        arraysize: int = 1000,
     ) -> Any:
-        conn = self.conn
         try:
-            c = conn.cursor()
-            self._execute_and_log(c, query)
-            res = c.fetchall()
+            c = self._execute_and_log(query)
+            # rows are converted as they are fetched rather than materialized first
+            res = self._iter_cursor(c, arraysize)
+            if return_dictionaries:
+                # read the column names once rather than once per row
+                cols = tuple(d[0] for d in c.description)
+                if id_col is None:
+                    return [dict(zip(cols, row)) for row in res]
+                return {row[id_col]: dict(zip(cols, row)) for row in res}
+
             if id_col is None:
-                conv_res: Any = []
-                if return_dictionaries:
-                    for row in res:
-                        conv_res.append(dict(row))
-                else:
-                    if raw:
-                        conv_res = res
-                    else:
-                        for row in res:
-                            conv_res.append(list(row))
-            else:
-                conv_res = {}
-                if return_dictionaries:
-                    for row in res:
-                        conv_res[row[id_col]] = dict(row)
-                else:
-                    for row in res:
-                        conv_res[row[id_col]] = list(row)
-
-            return conv_res
+                if raw:
+                    return list(res)
+                return [list(row) for row in res]
+            return {row[id_col]: list(row) for row in res}
+        except SQLiteQueryError:
+            if self._in_transaction_block():
+                raise
+            current_app.logger.error("%s select failed %s", self.db, query)
+            return [] if id_col is None else {}
         except sqlite3.Error as e:
             current_app.logger.error("%s Error %s %s", self.db, e, query)
-            sys.exit(1)
+            raise SQLiteError(str(e)) from e
+
+    @staticmethod
+    def _iter_cursor(c: sqlite3.Cursor, arraysize: int) -> Iterator[sqlite3.Row]:
+        c.arraysize = arraysize
+        while True:
+            batch = c.fetchmany()
+            if not batch:
+                break
+            yield from batch
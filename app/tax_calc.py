@@ -1,25 +1,77 @@
+import contextlib
 import csv
 import datetime
+import io
+import itertools
+import operator
 import os
 import pickle
 import pprint
 import re
 import sys
-import traceback
 import zipfile
+from collections import defaultdict, deque
 
 from flask import current_app
 
 from .constants import USER_DIRNAME
 from .util import decustom, log, log_error, timestamp_to_date
 
+HTML_TAG_RE = re.compile("<[^<]+?>")
+FEE_TREATMENTS = frozenset(("fee", "custom:fee"))
+# the fields process_transactions reads off every transfer it keeps
+TRANSFER_FIELDS = operator.itemgetter("id", "what", "symbol", "token_nft_id", "rate", "amount")
+LOAN_TREATMENTS = frozenset(("borrow", "repay", "full_repay", "liquidation"))
+VAULT_TREATMENTS = frozenset(("deposit", "withdraw", "exit"))
+
+# tax form archives are written a row at a time; buffer them in large chunks, not 8 KiB ones
+FORM_BUFFER_SIZE = 1 << 20
+# deflate level for downloaded archives, zlib's usual speed/size tradeoff
+ZIP_COMPRESS_LEVEL = 6
+# archive members smaller than this are stored rather than deflated
+ZIP_STORE_LIMIT = 4096
+
+# income description by transaction function
+INCOME_TEXTS = {
+    "chain-split": "Income from a cryptocurrency chain fork",
+    "interest": "Interest income",
+    "mining": "Cryptocurrency mining income",
+    "airdrop": "Cryptocurrency user incentive income",
+    "cashback": "Cryptocurrency cashback",
+    "royalty": "Cryptocurrency royalties",
+    "royalties": "Cryptocurrency royalties",
+}
+
 
 class Token:
+    # _default_symbol and _default_what are the shortest symbol across chains and its contract,
+    # filled in lazily by symbol()
+    __slots__ = ("id", "symbols", "coingecko_id", "nft_id", "_default_symbol", "_default_what")
+
     def __init__(self, id, chain_name, what, symbol, coingecko_id, nft_id):
-        self.id = id
+        self.id = sys.intern(id)
         self.symbols = {chain_name: [symbol, what]}
         self.coingecko_id = coingecko_id
         self.nft_id = nft_id
+        self._default_symbol = None
+        self._default_what = None
+
+    def __getstate__(self):
+        return {
+            "id": self.id,
+            "symbols": self.symbols,
+            "coingecko_id": self.coingecko_id,
+            "nft_id": self.nft_id,
+        }
+
+    def __setstate__(self, state):
+        # also restores tokens pickled into calculator caches before Token had __slots__
+        self.id = sys.intern(state["id"])
+        self.symbols = state["symbols"]
+        self.coingecko_id = state["coingecko_id"]
+        self.nft_id = state["nft_id"]
+        self._default_symbol = None
+        self._default_what = None
 
     @classmethod
     def lookup_or_create_token(
@@ -39,7 +91,11 @@ class Token:
         return token_dict[id]
 
     def add_chain(self, chain_name, what, symbol):
-        self.symbols[chain_name] = [symbol, what]
+        # called for every transfer of the token, only drop the cached default symbol on changes
+        pair = [symbol, what]
+        if self.symbols.get(chain_name) != pair:
+            self.symbols[chain_name] = pair
+            self._default_symbol = None
 
     def symbol(self, chain_name=None, what_instead=False):
         if chain_name is not None:
@@ -47,23 +103,20 @@ class Token:
                 return self.symbols[chain_name][1]
             return self.symbols[chain_name][0]
 
-        shortest = "X" * 10000
-        for chain_name, pair in self.symbols.items():
-            if pair[0] is None:
-                log("No symbol in pair?", chain_name, pair, filename="aux_log.txt")
-                pair[0] = ""
-            if len(pair[0]) < len(shortest):
-                shortest = pair[0]
-                shortest_what = pair[1]
-        assert len(shortest) < 10000
+        if self._default_symbol is None:
+            for chain_name, pair in self.symbols.items():
+                if pair[0] is None:
+                    log("No symbol in pair?", chain_name, pair, filename="aux_log.txt")
+                    pair[0] = ""
+            self._default_symbol, self._default_what = min(
+                self.symbols.values(), key=lambda pair: len(pair[0])
+            )
         if what_instead:
-            return shortest_what
-        return shortest
+            return self._default_what
+        return self._default_symbol
 
     def __eq__(self, other):
-        if type(self) is type(other) and self.id is other.id:
-            return True
-        return False
+        return type(self) is type(other) and self.id == other.id
 
     def __hash__(self):
         return hash(self.id)
@@ -96,18 +149,28 @@ class Token:
         return self.__str__()
 
 
-def timestamp_to_year(ts):
-    return datetime.datetime.fromtimestamp(ts).year
+def year_bounds(year):
+    # [start, end) timestamps of the year in local time, as datetime.fromtimestamp reads them
+    return datetime.datetime(year, 1, 1).timestamp(), datetime.datetime(year + 1, 1, 1).timestamp()
 
 
-def rate_pick(token, timestamp, running_rates, coingecko_rates, fiat_rate):
-    try:
-        running_rate, running_ts = running_rates[token]
-    except:
-        running_rate = 0
-        running_ts = timestamp
-    what = token.symbol(what_instead=True)
-    if (running_rate != 0 and timestamp - running_ts < 3600) or ("_" in what):
+def rate_pick(token, timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache=None):
+    # the same token is priced many times at one timestamp while processing a single transaction;
+    # reuse the result as long as its running rate hasn't been updated since
+    if rate_cache is not None:
+        key = (token.id, timestamp, fiat_rate)
+        running = running_rates.get(token)
+        cached = rate_cache.get(key)
+        if cached is not None and cached[1] == running:
+            return cached[0]
+        rate = rate_pick(token, timestamp, running_rates, coingecko_rates, fiat_rate)
+        rate_cache[key] = (rate, running)
+        return rate
+
+    running_rate, running_ts = running_rates.get(token, (0, timestamp))
+    if running_rate != 0 and timestamp - running_ts < 3600:
+        return running_rate
+    if "_" in token.symbol(what_instead=True):
         return running_rate
     coingecko_id_or_cp = token.id
 
@@ -117,7 +180,56 @@ def rate_pick(token, timestamp, running_rates, coingecko_rates, fiat_rate):
     return running_rate
 
 
+def sum_usd(amounts, rates):
+    # amounts and rates are parallel sequences; returns total value, whether nothing is held,
+    # and whether any token is missing a rate
+    empty = max(amounts, default=0) <= 0
+    bad = not all(rates)
+    return sum(map(operator.mul, amounts, rates)), empty, bad
+
+
+def history_json(history):
+    # vault and loan history entries are (txid, trid, action, token id, amount, extra fields)
+    # tuples, expanded here; caches pickled before that hold the dicts already
+    js = []
+    for entry in history:
+        if isinstance(entry, dict):
+            js.append(entry)
+            continue
+        txid, trid, action, token_id, amount, extra = entry
+        entry_js = {"txid": txid, "trid": trid, "action": action}
+        if token_id is not None:
+            entry_js["token"] = token_id
+            entry_js["amount"] = amount
+        if extra is not None:
+            entry_js.update(extra)
+        js.append(entry_js)
+    return js
+
+
+@contextlib.contextmanager
+def zip_text_file(zf, filename, newline=None):
+    # gathered in memory and added in one go: writestr dates the entry, ZipFile.open() leaves
+    # it at 1980, and deflating a form of a few lines costs more than it saves
+    text_file = io.StringIO(newline=newline)
+    yield text_file
+    data = text_file.getvalue().encode("utf-8")
+    compress_type = zipfile.ZIP_STORED if len(data) < ZIP_STORE_LIMIT else zipfile.ZIP_DEFLATED
+    zf.writestr(filename, data, compress_type=compress_type, compresslevel=ZIP_COMPRESS_LEVEL)
+
+
 class Vault:
+    __slots__ = (
+        "id",
+        "holdings",
+        "usd_total",
+        "usd_max",
+        "history",
+        "warnings",
+        "vault_gain",
+        "vault_loss",
+    )
+
     def __init__(self, id, vault_gain="income", vault_loss="loss"):
         self.id = id
         self.holdings = {}
@@ -128,50 +240,61 @@ class Vault:
         self.vault_gain = vault_gain
         self.vault_loss = vault_loss
 
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        # vaults pickled before __slots__ (or before vault_gain/vault_loss) restore the same way
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def __str__(self):
         return "VAULT " + str(self.id) + " holdings " + str(self.holdings)
 
     def __repr__(self):
         return self.__str__()
 
-    def total_usd(self, timestamp, running_rates, coingecko_rates, fiat_rate):
-        total = 0
-        empty = True
-        bad = False
-        for token, amt in self.holdings.items():
-            rate = rate_pick(token, timestamp, running_rates, coingecko_rates, fiat_rate)
-            if amt > 0:
-                empty = False
-            if rate == 0 or rate is None:
-                bad = True
-            total += amt * rate
-        return total, empty, bad
+    def holding_rates(self, timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache=None):
+        return {
+            token: rate_pick(
+                token, timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache
+            )
+            for token in self.holdings
+        }
+
+    def total_usd(self, timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache=None):
+        rates = self.holding_rates(timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache)
+        return sum_usd(self.holdings.values(), list(rates.values()))
 
     def deposit(self, transaction, trid, token, amount):
         if token not in self.holdings:
             self.holdings[token] = 0
         self.holdings[token] += amount
-        self.history.append(
-            {
-                "txid": transaction["txid"],
-                "trid": trid,
-                "action": "deposit",
-                "token": token.id,
-                "amount": amount,
-            }
-        )
+        self.history.append((transaction["txid"], trid, "deposit", token.id, amount, None))
 
     def withdraw(
-        self, transaction, trid, token, amount, running_rates, coingecko_rates, usd_fee, exit=False
+        self,
+        transaction,
+        ordered_transfers,
+        trid,
+        token,
+        amount,
+        running_rates,
+        coingecko_rates,
+        usd_fee,
+        exit=False,
+        rate_cache=None,
+        debug=False,
     ):
         orig_amount = amount
         timestamp = transaction["ts"]
         txid = transaction["txid"]
         fiat_rate = transaction["fiat_rate"]
         log("WITHDRAW", self.id, token, amount)
-        usd_total, _empty, _bad = self.total_usd(
-            timestamp, running_rates, coingecko_rates, fiat_rate
+        entry_rates = self.holding_rates(
+            timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache
         )
+        usd_total, _empty, _bad = sum_usd(self.holdings.values(), list(entry_rates.values()))
 
         self.usd_max = max(self.usd_max, usd_total)
 
@@ -191,6 +314,8 @@ class Vault:
             self.holdings[token] = 0
 
         trades = []
+        add_trade = trades.append
+        add_history = self.history.append
         incomes = []
         expenses = []
 
@@ -210,105 +335,136 @@ class Vault:
 
             # next, withdraw from other tokens and record swapping transactions
             holding_keys = list(self.holdings.keys())
-            rate = rate_pick(token, timestamp, running_rates, coingecko_rates, fiat_rate)
+            rate = rate_pick(
+                token, timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache
+            )
 
-            holding_keys_reordered = []
-            for key_idx in range(len(holding_keys)):  # convert similar named tokens first
-                other_token = holding_keys[key_idx]
+            # convert similar named tokens first, in reverse holding order
+            token_symbol = token.symbol()
+            similar = []
+            other = []
+            for other_token in holding_keys:
                 log("comp", other_token, token)
-                if token.symbol() in other_token.symbol() or other_token.symbol() in token.symbol():
-                    holding_keys_reordered.insert(0, other_token)
+                other_symbol = other_token.symbol()
+                if token_symbol in other_symbol or other_symbol in token_symbol:
+                    similar.append(other_token)
                     log("do reorder ", other_token, "in front")
                 else:
-                    holding_keys_reordered.append(other_token)
+                    other.append(other_token)
+            holding_keys_reordered = similar
+            holding_keys_reordered.reverse()
+            holding_keys_reordered.extend(other)
 
             log("original", holding_keys, "reordered", holding_keys_reordered)
 
-            key_idx = 0
-            while key_idx < len(holding_keys_reordered):
-                usd_amt = amount * rate
-                other_token = holding_keys_reordered[key_idx]
+            # the rest of the holdings don't change until the loop reaches them, so price them
+            # all up front and only visit the ones worth converting from
+            candidates = []
+            for other_token in holding_keys_reordered:
                 if other_token == token:
-                    key_idx += 1
                     continue
                 other_rate = rate_pick(
-                    other_token, timestamp, running_rates, coingecko_rates, fiat_rate
+                    other_token, timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache
                 )
                 other_available = self.holdings[other_token]
                 other_usd_amt = other_available * other_rate
                 if other_usd_amt > 0.01:
-                    if other_usd_amt > usd_amt:
-                        other_sold = usd_amt / other_rate
-                        if amount * rate > 0.01:
-                            log(
-                                self.id,
-                                "WITHDRAW:CONVERSION: bought",
-                                amount,
-                                "of",
-                                token.symbol(),
-                                ", sold",
-                                other_sold,
-                                "of",
-                                other_token.symbol(),
-                            )
-                            self.history.append(
+                    candidates.append((other_token, other_rate, other_available, other_usd_amt))
+
+            for other_token, other_rate, other_available, other_usd_amt in candidates:
+                usd_amt = amount * rate
+                if other_usd_amt > usd_amt:
+                    other_sold = usd_amt / other_rate
+                    if amount * rate > 0.01:
+                        log(
+                            self.id,
+                            "WITHDRAW:CONVERSION: bought",
+                            amount,
+                            "of",
+                            token.symbol(),
+                            ", sold",
+                            other_sold,
+                            "of",
+                            other_token.symbol(),
+                        )
+                        add_history(
+                            (
+                                txid,
+                                trid,
+                                "conversion",
+                                None,
+                                None,
                                 {
-                                    "txid": transaction["txid"],
-                                    "trid": trid,
-                                    "action": "conversion",
                                     "from": {"token": other_token.id, "amount": other_sold},
                                     "to": {"token": token.id, "amount": amount},
-                                }
+                                },
                             )
-                            trades.append(
-                                CA_transaction(timestamp, token, amount, rate, txid, trid)
-                            )
-                            trades.append(
-                                CA_transaction(
-                                    timestamp, other_token, -other_sold, other_rate, txid, trid
-                                )
+                        )
+                        add_trade(
+                            CA_transaction(timestamp, token, amount, rate, txid, trid, debug=debug)
+                        )
+                        add_trade(
+                            CA_transaction(
+                                timestamp,
+                                other_token,
+                                -other_sold,
+                                other_rate,
+                                txid,
+                                trid,
+                                debug=debug,
                             )
-                            self.holdings[other_token] -= other_sold
-                            performed_conversion = True
-                        amount = 0
-                        break
-                    try:
-                        amount_bought = other_usd_amt / rate
-                    except:
-                        log(self.id, "EXCEPTION", traceback.format_exc(), token)
-                        log(transaction)
-                        amount_bought = other_usd_amt
-                    log(
-                        self.id,
-                        "WITHDRAW:CONVERSION: bought",
-                        amount_bought,
-                        "of",
-                        token.symbol(),
-                        ", sold",
-                        other_available,
-                        "of",
-                        other_token.symbol(),
-                    )
-                    self.history.append(
+                        )
+                        self.holdings[other_token] -= other_sold
+                        performed_conversion = True
+                    amount = 0
+                    break
+                if rate:
+                    amount_bought = other_usd_amt / rate
+                else:
+                    log(self.id, "No rate for withdrawn token", token)
+                    log(transaction)
+                    amount_bought = other_usd_amt
+                log(
+                    self.id,
+                    "WITHDRAW:CONVERSION: bought",
+                    amount_bought,
+                    "of",
+                    token.symbol(),
+                    ", sold",
+                    other_available,
+                    "of",
+                    other_token.symbol(),
+                )
+                add_history(
+                    (
+                        txid,
+                        trid,
+                        "conversion",
+                        None,
+                        None,
                         {
-                            "txid": transaction["txid"],
-                            "trid": trid,
-                            "action": "conversion",
                             "from": {"token": other_token.id, "amount": other_available},
                             "to": {"token": token.id, "amount": amount_bought},
-                        }
+                        },
                     )
-                    trades.append(CA_transaction(timestamp, token, amount_bought, rate, txid, trid))
-                    trades.append(
-                        CA_transaction(
-                            timestamp, other_token, -other_available, other_rate, txid, trid
-                        )
+                )
+                add_trade(
+                    CA_transaction(timestamp, token, amount_bought, rate, txid, trid, debug=debug)
+                )
+                add_trade(
+                    CA_transaction(
+                        timestamp,
+                        other_token,
+                        -other_available,
+                        other_rate,
+                        txid,
+                        trid,
+                        debug=debug,
                     )
-                    performed_conversion = True
-                    self.holdings[other_token] = 0
-                    amount -= amount_bought
-
-                key_idx += 1
+                )
+                performed_conversion = True
+                self.holdings[other_token] = 0
+                amount -= amount_bought
 
             if performed_conversion and not warning_issued:
                 self.warnings.append(
@@ -327,22 +483,11 @@ class Vault:
                 )
 
         # if we're out of money, the rest is profit
-        self.history.append(
-            {
-                "txid": transaction["txid"],
-                "trid": trid,
-                "action": "withdraw",
-                "token": token.id,
-                "amount": orig_amount,
-            }
-        )
+        add_history((txid, trid, "withdraw", token.id, orig_amount, None))
         if amount > 0:
             log(self.id, "WITHDRAW:NOT ENOUGH HOLDINGS")
             # may not be a property if calculator is loaded from cache
-            try:
-                vault_gain = self.vault_gain
-            except:
-                vault_gain = "income"
+            vault_gain = getattr(self, "vault_gain", "income")
 
             if vault_gain == "income":
                 incomes.append(
@@ -356,28 +501,16 @@ class Vault:
                     }
                 )
                 log(self.id, "WITHDRAW:profit ", amount, "of", token)
-                self.history.append(
-                    {
-                        "txid": transaction["txid"],
-                        "trid": trid,
-                        "action": "income on exit",
-                        "token": token.id,
-                        "amount": amount,
-                    }
+                add_history((txid, trid, "income on exit", token.id, amount, None))
+                add_trade(
+                    CA_transaction(timestamp, token, amount, rate, txid, trid, usd_fee, debug=debug)
                 )
-                trades.append(CA_transaction(timestamp, token, amount, rate, txid, trid, usd_fee))
 
             if vault_gain == "gain":
-                self.history.append(
-                    {
-                        "txid": transaction["txid"],
-                        "trid": trid,
-                        "action": "capgain on exit",
-                        "token": token.id,
-                        "amount": amount,
-                    }
+                add_history((txid, trid, "capgain on exit", token.id, amount, None))
+                add_trade(
+                    CA_transaction(timestamp, token, amount, 0, txid, trid, usd_fee, debug=debug)
                 )
-                trades.append(CA_transaction(timestamp, token, amount, 0, txid, trid, usd_fee))
             close = 1
 
             if amount * rate > self.usd_max * 0.3:
@@ -393,9 +526,14 @@ class Vault:
         else:
             close = 0
 
-            remaining_usd, vault_empty, vault_bad_rate = self.total_usd(
-                timestamp, running_rates, coingecko_rates, fiat_rate
-            )
+            if self.holdings.keys() == entry_rates.keys():
+                # only amounts changed since entry, so the rates priced then still apply
+                remaining = sum_usd(self.holdings.values(), list(entry_rates.values()))
+            else:
+                remaining = self.total_usd(
+                    timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache
+                )
+            remaining_usd, vault_empty, vault_bad_rate = remaining
             log("withdrawal", self.id, remaining_usd, vault_empty, vault_bad_rate, exit)
             if (remaining_usd < 0.001 * self.usd_max and not vault_bad_rate) or vault_empty or exit:
                 close = 1
@@ -403,14 +541,11 @@ class Vault:
         if close:
             # make sure it's the last transfer in transaction mentionining this vault
             check = False
-            for transfer in transaction["ordered_transfers"]:
+            for transfer, other_treatment, other_vault_id in ordered_transfers:
                 if transfer["id"] == trid:
                     check = True
                     continue
                 if check:
-                    other_vault_id, _ = decustom(transfer["vault_id"])
-                    other_treatment, _ = decustom(transfer["treatment"])
-
                     if other_vault_id == self.id and other_treatment in [
                         "withdraw",
                         "deposit",
@@ -421,14 +556,16 @@ class Vault:
                         break
 
             if close:
+                vault_loss = getattr(self, "vault_loss", "loss")
                 for loss_tok, loss_amt in self.holdings.items():
                     if loss_amt > 0:
-                        try:
-                            vault_loss = self.vault_loss
-                        except:
-                            vault_loss = "loss"
                         loss_rate = rate_pick(
-                            loss_tok, timestamp, running_rates, coingecko_rates, fiat_rate
+                            loss_tok,
+                            timestamp,
+                            running_rates,
+                            coingecko_rates,
+                            fiat_rate,
+                            rate_cache,
                         )
 
                         log(
@@ -442,32 +579,42 @@ class Vault:
                             loss_rate,
                         )
                         if vault_loss == "loss":
-                            self.history.append(
-                                {
-                                    "txid": transaction["txid"],
-                                    "trid": trid,
-                                    "action": "loss on exit",
-                                    "token": loss_tok.id,
-                                    "amount": loss_amt,
-                                }
+                            add_history(
+                                (
+                                    txid,
+                                    trid,
+                                    "loss on exit",
+                                    loss_tok.id,
+                                    loss_amt,
+                                    None,
+                                )
                             )
-                            trades.append(
-                                CA_transaction(timestamp, loss_tok, -loss_amt, 0, txid, trid)
+                            add_trade(
+                                CA_transaction(
+                                    timestamp, loss_tok, -loss_amt, 0, txid, trid, debug=debug
+                                )
                             )
 
                         if vault_loss == "sell":
-                            self.history.append(
-                                {
-                                    "txid": transaction["txid"],
-                                    "trid": trid,
-                                    "action": "sell on exit",
-                                    "token": loss_tok.id,
-                                    "amount": loss_amt,
-                                }
+                            add_history(
+                                (
+                                    txid,
+                                    trid,
+                                    "sell on exit",
+                                    loss_tok.id,
+                                    loss_amt,
+                                    None,
+                                )
                             )
-                            trades.append(
+                            add_trade(
                                 CA_transaction(
-                                    timestamp, loss_tok, -loss_amt, loss_rate, txid, trid
+                                    timestamp,
+                                    loss_tok,
+                                    -loss_amt,
+                                    loss_rate,
+                                    txid,
+                                    trid,
+                                    debug=debug,
                                 )
                             )
 
@@ -481,25 +628,30 @@ class Vault:
                                     "trid": trid,
                                 }
                             )
-                            self.history.append(
-                                {
-                                    "txid": transaction["txid"],
-                                    "trid": trid,
-                                    "action": "expense on exit",
-                                    "token": loss_tok.id,
-                                    "amount": loss_amt,
-                                }
+                            add_history(
+                                (
+                                    txid,
+                                    trid,
+                                    "expense on exit",
+                                    loss_tok.id,
+                                    loss_amt,
+                                    None,
+                                )
                             )
-                            trades.append(
+                            add_trade(
                                 CA_transaction(
-                                    timestamp, loss_tok, -loss_amt, loss_rate, txid, trid
+                                    timestamp,
+                                    loss_tok,
+                                    -loss_amt,
+                                    loss_rate,
+                                    txid,
+                                    trid,
+                                    debug=debug,
                                 )
                             )
 
                 log(self.id, "vault closed in tx ", transaction["hash"])
-                self.history.append(
-                    {"txid": transaction["txid"], "trid": trid, "action": "vault closed"}
-                )
+                add_history((txid, trid, "vault closed", None, None, None))
                 self.holdings = {}
                 self.usd_total = 0
                 self.usd_max = 0
@@ -511,7 +663,7 @@ class Vault:
         for token, amount in self.holdings.items():
             holdings_conv.append([token.id, amount])
         js = {
-            "history": self.history,
+            "history": history_json(self.history),
             "warnings": self.warnings,
             "holdings": holdings_conv,
             # 'holdings':self.holdings #can't do that because keys aren't strings
@@ -521,6 +673,8 @@ class Vault:
 
 
 class Loan:
+    __slots__ = ("id", "loaned", "usd_total", "usd_max", "history", "warnings")
+
     def __init__(self, id):
         self.id = id
         self.loaned = {}
@@ -529,23 +683,27 @@ class Loan:
         self.history = []
         self.warnings = []
 
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def __str__(self):
         return "LOAN " + self.id + " loaned " + str(self.loaned)
 
     def __repr__(self):
         return self.__str__()
 
-    def total_usd(self, timestamp, running_rates, coingecko_rates, fiat_rate):
-        total = 0
-        empty = True
-        for token, amt in self.loaned.items():
-            rate = rate_pick(token, timestamp, running_rates, coingecko_rates, fiat_rate)
-            if amt > 0:
-                empty = False
-            if rate == 0 or rate is None:
-                total = None
-            if total is not None:
-                total += amt * rate
+    def total_usd(self, timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache=None):
+        rates = [
+            rate_pick(token, timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache)
+            for token in self.loaned
+        ]
+        total, empty, bad = sum_usd(self.loaned.values(), rates)
+        if bad:
+            total = None
         return total, empty
 
     def borrow(self, transaction, trid, token, amount):
@@ -553,12 +711,20 @@ class Loan:
         if token not in self.loaned:
             self.loaned[token] = 0
         self.loaned[token] += amount
-        self.history.append(
-            {"txid": txid, "trid": trid, "action": "borrow", "token": token.id, "amount": amount}
-        )
+        self.history.append((txid, trid, "borrow", token.id, amount, None))
 
     def repay(
-        self, transaction, trid, token, amount, running_rates, coingecko_rates, _usd_fee, exit=False
+        self,
+        transaction,
+        trid,
+        token,
+        amount,
+        running_rates,
+        coingecko_rates,
+        _usd_fee,
+        exit=False,
+        rate_cache=None,
+        debug=False,
     ):
         txid = transaction["txid"]
         fiat_rate = transaction["fiat_rate"]
@@ -578,9 +744,7 @@ class Loan:
             )
 
         interest_payments = []
-        self.history.append(
-            {"txid": txid, "trid": trid, "action": "repay", "token": token.id, "amount": amount}
-        )
+        self.history.append((txid, trid, "repay", token.id, amount, None))
 
         # first, repay with capital. If there's enough, we're done
         if self.loaned[token] >= amount:
@@ -592,7 +756,7 @@ class Loan:
 
         # if we're out of money, the rest is profit
         timestamp = transaction["ts"]
-        rate = rate_pick(token, timestamp, running_rates, coingecko_rates, fiat_rate)
+        rate = rate_pick(token, timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache)
 
         if amount > 0:
             # print("REPAY LOAN:REPAYING MORE THAN LOANED")
@@ -618,41 +782,28 @@ class Loan:
                     "trid": trid,
                 }
             )
-            rate = rate_pick(token, timestamp, running_rates, coingecko_rates, fiat_rate)
+            rate = rate_pick(
+                token, timestamp, running_rates, coingecko_rates, fiat_rate, rate_cache
+            )
             trades.append(
-                CA_transaction(timestamp, token, -amount, rate, txid, trid, queue_only=True)
+                CA_transaction(
+                    timestamp, token, -amount, rate, txid, trid, queue_only=True, debug=debug
+                )
             )  # loss of assets
-            self.history.append(
-                {
-                    "txid": txid,
-                    "trid": trid,
-                    "action": "pay interest",
-                    "token": token.id,
-                    "amount": amount,
-                }
-            )
+            self.history.append((txid, trid, "pay interest", token.id, amount, None))
 
         if exit:  # assuming we were liquidated, acquire the rest of the loan for free
             for _lookup, amt in self.loaned.items():
                 if amt != 0:
-                    self.history.append(
-                        {
-                            "txid": txid,
-                            "trid": trid,
-                            "action": "buy loaned",
-                            "token": token.id,
-                            "amount": amt,
-                            "rate": 0,
-                        }
-                    )
-                    trades.append(CA_transaction(timestamp, token, amt, 0, txid, trid))
+                    self.history.append((txid, trid, "buy loaned", token.id, amt, {"rate": 0}))
+                    trades.append(CA_transaction(timestamp, token, amt, 0, txid, trid, debug=debug))
             self.loaned = {}
 
         for _what, amt in self.loaned.items():
             if amt != 0:
                 break
         else:
-            self.history.append({"txid": txid, "trid": trid, "action": "loan repaid"})
+            self.history.append((txid, trid, "loan repaid", None, None, None))
 
         return interest_payments, trades
 
@@ -661,7 +812,7 @@ class Loan:
         for token, amount in self.loaned.items():
             holdings_conv.append([token.id, amount])
         js = {
-            "history": self.history,
+            "history": history_json(self.history),
             "warnings": self.warnings,
             "loaned": holdings_conv,
         }
@@ -669,7 +820,22 @@ class Loan:
 
 
 class CA_transaction:
-    def __init__(self, timestamp, token, amount, rate, txid, trid, usd_fee=0, queue_only=False):
+    __slots__ = (
+        "timestamp",
+        "amount",
+        "rate",
+        "queue_only",
+        "token",
+        "basis",
+        "sale",
+        "usd_fee",
+        "txid",
+        "trid",
+    )
+
+    def __init__(
+        self, timestamp, token, amount, rate, txid, trid, usd_fee=0, queue_only=False, debug=False
+    ):
         if rate is None:
             rate = 0
         self.timestamp = timestamp
@@ -689,25 +855,34 @@ class CA_transaction:
             self.sale = -amount * rate
         self.txid = txid
         self.trid = trid
-        log(
-            "CA_trans",
-            "txid",
-            txid,
-            "trid",
-            trid,
-            "token",
-            token,
-            "amount",
-            amount,
-            "rate",
-            rate,
-            "basis",
-            self.basis,
-            "sale",
-            self.sale,
-            "usd fee",
-            usd_fee,
-        )
+        if debug:
+            log(
+                "CA_trans",
+                "txid",
+                txid,
+                "trid",
+                trid,
+                "token",
+                token,
+                "amount",
+                amount,
+                "rate",
+                rate,
+                "basis",
+                self.basis,
+                "sale",
+                self.sale,
+                "usd fee",
+                usd_fee,
+            )
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        # also restores transactions pickled into calculator caches before __slots__ were added
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def __str__(self):
         s = str(self.timestamp) + " "
@@ -745,7 +920,7 @@ class Calculator:
             self.tx_costs = tx_costs
         self.coingecko_rates = coingecko_rates
 
-        self.hash = "0x71c7440948f9278d728a0506ebb65853bd2d4ac8f7cbff75af888c283f293e97"
+        self.debug_hashes = current_app.config.get("DEBUG_HASHES", frozenset())
 
         self.ca_transactions = []
         self.incomes = []
@@ -766,16 +941,23 @@ class Calculator:
         fiat = user.fiat
 
         running_rates = {}
+        rate_cache = {}
 
         vaults = self.vaults
         loans = self.loans
+        tokens = self.tokens
+        coingecko_rates = self.coingecko_rates
+        add_ca_transaction = self.ca_transactions.append
+        extend_ca_transactions = self.ca_transactions.extend
+        add_income = self.incomes.append
+        add_interest_payment = self.interest_payments.append
+        add_business_expense = self.business_expenses.append
 
-        try:
-            tx_costs = self.tx_costs
-        except:
-            tx_costs = "sell"
+        tx_costs = getattr(self, "tx_costs", "sell")
+        # every capital asset transaction is logged as it's created when debugging
+        debug_trades = current_app.config["DEBUG_LEVEL"] > 0
 
-        for _tidx, transaction in enumerate(transactions_js):
+        for transaction in transactions_js:
             hash = transaction["hash"]
             txid = transaction["txid"]
             fiat_rate = transaction["fiat_rate"]
@@ -785,15 +967,29 @@ class Calculator:
                 originator = None
             timestamp = transaction["ts"]
             function = transaction["function"]
+            chain = transaction["chain"]
+
+            explanation = ""
+            custom_note = transaction.get("custom_note")
+            if custom_note:
+                note = HTML_TAG_RE.sub("", custom_note)
+                if len(note) > 0:
+                    explanation = " (" + note + ")"
 
-            if hash == self.hash:
+            debug = hash in self.debug_hashes
+            if debug:
                 pprint.pprint(transaction)
             transfers = list(transaction["rows"].values())
+            # fees are spread over, and transfers reordered between, several transfers only
+            multi_transfer = len(transfers) > 1
 
             fee_amount_per_transaction = fee_rate = fee_amount = None
             fee_transfers = []
-            if len(transfers) > 1:
-                cnt = 0
+            cnt = 0
+            # without a fee there's nothing to spread over the other transfers
+            if multi_transfer and any(
+                transfer["treatment"] in FEE_TREATMENTS for transfer in transfers
+            ):
                 usd_fee_amount = 0
                 for transfer in transfers:
                     treatment, _ = decustom(transfer["treatment"])
@@ -819,105 +1015,114 @@ class Calculator:
                     for transfer in fee_transfers:
                         transfer["treatment"] = "sell"
 
-            if (
-                transaction["hash"]
-                == "0x7227cc0fd7353fd646be7d00d792c492dc9abd63dc7189e2e80c51dd3cd7b988"
-            ):
+            if debug:
                 log("CALCULATOR FEES", fee_transfers, "CNT", cnt, fee_amount_per_transaction)
 
             # assume outbound transfers involving contract caller execute first
-            if originator is not None:
+            if originator is not None and multi_transfer:
                 foreign_batch = []
                 native_batch = []
 
                 # find last outgoing transfer from the caller, insert foreign transfers after
-                for t_idx, transfer in enumerate(transfers):
-                    if originator not in [transfer["fr"], transfer["to"]]:
+                for transfer in transfers:
+                    if originator not in (transfer["fr"], transfer["to"]):
                         foreign_batch.append(transfer)
                     else:
                         native_batch.append(transfer)
-                for t_idx in range(len(native_batch) - 1, -1, -1):
-                    if native_batch[t_idx]["fr"] == originator:
-                        transfers = native_batch[:t_idx] + foreign_batch + native_batch[t_idx:]
-                        break
-            transaction["ordered_transfers"] = transfers
+                # with no foreign transfers the order is already right
+                if foreign_batch:
+                    for t_idx in range(len(native_batch) - 1, -1, -1):
+                        if native_batch[t_idx]["fr"] == originator:
+                            transfers = native_batch[:t_idx] + foreign_batch + native_batch[t_idx:]
+                            break
+            # parse custom treatments and vault ids once, vault closing checks need them again
+            ordered_transfers = [
+                (
+                    transfer,
+                    decustom(transfer["treatment"])[0],
+                    decustom(transfer.get("vault_id"))[0],
+                )
+                for transfer in transfers
+            ]
 
-            for transfer in transfers:
-                treatment, _ = decustom(transfer["treatment"])
+            for transfer, treatment, vault_id in ordered_transfers:
+                # fiat legs are the common skip; ignore means IGNORE!
                 coingecko_id = transfer["coingecko_id"]
-                if (
-                    treatment is None or treatment == "ignore" or coingecko_id == fiat
-                ):  # ignore means IGNORE!
+                if coingecko_id == fiat or treatment is None or treatment == "ignore":
                     continue
 
-                trid = transfer["id"]
-                try:
-                    contract = transfer["what"]
-                except:
+                if "what" not in transfer:
                     log("bad transfer", transfer)
                     sys.exit(1)
-                symbol = transfer["symbol"]
-
-                nft_id = transfer["token_nft_id"]
+                trid, contract, symbol, nft_id, rate, amount = TRANSFER_FIELDS(transfer)
 
                 token = Token.lookup_or_create_token(
-                    self.tokens, transaction["chain"], contract, symbol, coingecko_id, nft_id
+                    tokens, chain, contract, symbol, coingecko_id, nft_id
                 )
 
-                rate = transfer["rate"]
                 if rate is None:
                     rate = 0
-                rate = str(rate)
-                custom_rate = False
-                if "custom" in rate:
-                    custom_rate = True
-                    rate = rate[7:]
-                if len(rate) == 0:
-                    rate = 0
+                if isinstance(rate, (int, float)):
+                    # most rates arrive as numbers, only custom or user-entered ones need parsing
+                    rate = float(rate) * fiat_rate
+                    running_rates[token] = (rate, timestamp)
                 else:
-                    try:
-                        rate = float(rate)
-                        if not custom_rate:
-                            rate *= fiat_rate
-                        running_rates[token] = (rate, timestamp)
-                    except:
+                    rate = str(rate)
+                    custom_rate = False
+                    if "custom" in rate:
+                        custom_rate = True
+                        rate = rate[7:]
+                    if len(rate) == 0:
                         rate = 0
+                    else:
+                        try:
+                            rate = float(rate)
+                            if not custom_rate:
+                                rate *= fiat_rate
+                            running_rates[token] = (rate, timestamp)
+                        except (TypeError, ValueError):
+                            rate = 0
 
-                amount = transfer["amount"]
+                usd_value = amount * rate
 
                 if treatment == "loss":
                     treatment = "sell"
 
-                if treatment in ["fee"]:
+                if treatment == "fee":
                     # these need to be later taken out of the fifo queue but ignored
                     # in cap gains calc
                     log("fee transfer in calc", transfer, "tx_costs", tx_costs, amount, rate)
                     if tx_costs == "sell":
-                        self.ca_transactions.append(
-                            CA_transaction(timestamp, token, -amount, rate, txid, trid)
+                        add_ca_transaction(
+                            CA_transaction(
+                                timestamp, token, -amount, rate, txid, trid, debug=debug_trades
+                            )
                         )
                     elif tx_costs == "expense":
-                        self.ca_transactions.append(
-                            CA_transaction(timestamp, token, -amount, rate, txid, trid)
+                        add_ca_transaction(
+                            CA_transaction(
+                                timestamp, token, -amount, rate, txid, trid, debug=debug_trades
+                            )
                         )
-                        self.business_expenses.append(
+                        add_business_expense(
                             {
                                 "timestamp": timestamp,
                                 "text": "Transaction cost",
-                                "amount": amount * rate,
+                                "amount": usd_value,
                                 "txid": txid,
                                 "trid": trid,
                             }
                         )
                     elif tx_costs == "loss":
-                        self.ca_transactions.append(
-                            CA_transaction(timestamp, token, -amount, 0, txid, trid)
+                        add_ca_transaction(
+                            CA_transaction(
+                                timestamp, token, -amount, 0, txid, trid, debug=debug_trades
+                            )
                         )
-
-                if treatment in ["buy", "sell"]:
+                elif treatment in ("buy", "sell"):
                     if treatment == "sell":
                         amount = -amount
-                    self.ca_transactions.append(
+                    add_ca_transaction(
                         CA_transaction(
                             timestamp,
                             token,
@@ -925,14 +1130,14 @@ class Calculator:
                             rate,
                             txid,
                             trid,
-                            usd_fee=fee_amount_per_transaction,
+                            fee_amount_per_transaction,
+                            debug=debug_trades,
                         )
                     )
-
-                if treatment in ["gift", "burn"]:
+                elif treatment in ("gift", "burn"):
                     if treatment == "burn":
                         amount = -amount
-                    self.ca_transactions.append(
+                    add_ca_transaction(
                         CA_transaction(
                             timestamp,
                             token,
@@ -940,43 +1145,26 @@ class Calculator:
                             0,
                             txid,
                             trid,
-                            usd_fee=fee_amount_per_transaction,
+                            fee_amount_per_transaction,
+                            debug=debug_trades,
                         )
                     )
+                elif treatment == "income":
+                    text = INCOME_TEXTS.get(
+                        function, "Cryptocurrency yield farming or similar income"
+                    )
 
-                try:
-                    note = re.sub("<[^<]+?>", "", transaction["custom_note"])
-                    if len(note) > 0:
-                        explanation = " (" + note + ")"
-                except:
-                    explanation = ""
-
-                if treatment == "income":
-                    text = "Cryptocurrency yield farming or similar income"
-                    if function == "chain-split":
-                        text = "Income from a cryptocurrency chain fork"
-                    elif function == "interest":
-                        text = "Interest income"
-                    elif function == "mining":
-                        text = "Cryptocurrency mining income"
-                    elif function == "airdrop":
-                        text = "Cryptocurrency user incentive income"
-                    elif function == "cashback":
-                        text = "Cryptocurrency cashback"
-                    elif function in ["royalty", "royalties"]:
-                        text = "Cryptocurrency royalties"
-
-                    self.incomes.append(
+                    add_income(
                         {
                             "timestamp": timestamp,
                             "text": text + explanation,
-                            "amount": amount * rate,
+                            "amount": usd_value,
                             "txid": txid,
                             "trid": trid,
-                            "hash": transaction["hash"],
+                            "hash": hash,
                         }
                     )
-                    self.ca_transactions.append(
+                    add_ca_transaction(
                         CA_transaction(
                             timestamp,
                             token,
@@ -984,11 +1172,11 @@ class Calculator:
                             rate,
                             txid,
                             trid,
-                            usd_fee=fee_amount_per_transaction,
+                            fee_amount_per_transaction,
+                            debug=debug_trades,
                         )
                     )
-
-                if treatment == "interest":
+                elif treatment == "interest":
                     log(
                         "interest",
                         "timestamp",
@@ -996,22 +1184,22 @@ class Calculator:
                         "text",
                         "Interest on a loan" + explanation,
                         "amount",
-                        amount * rate,
+                        usd_value,
                         "txid",
                         txid,
                         "trid",
                         trid,
                     )
-                    self.interest_payments.append(
+                    add_interest_payment(
                         {
                             "timestamp": timestamp,
                             "text": "Interest on a loan" + explanation,
-                            "amount": amount * rate,
+                            "amount": usd_value,
                             "txid": txid,
                             "trid": trid,
                         }
                     )
-                    self.ca_transactions.append(
+                    add_ca_transaction(
                         CA_transaction(
                             timestamp,
                             token,
@@ -1019,21 +1207,21 @@ class Calculator:
                             rate,
                             txid,
                             trid,
-                            usd_fee=fee_amount_per_transaction,
+                            fee_amount_per_transaction,
+                            debug=debug_trades,
                         )
                     )
-
-                if treatment == "expense":
-                    self.business_expenses.append(
+                elif treatment == "expense":
+                    add_business_expense(
                         {
                             "timestamp": timestamp,
                             "text": "Business expense" + explanation,
-                            "amount": amount * rate,
+                            "amount": usd_value,
                             "txid": txid,
                             "trid": trid,
                         }
                     )
-                    self.ca_transactions.append(
+                    add_ca_transaction(
                         CA_transaction(
                             timestamp,
                             token,
@@ -1041,24 +1229,12 @@ class Calculator:
                             rate,
                             txid,
                             trid,
-                            usd_fee=fee_amount_per_transaction,
+                            fee_amount_per_transaction,
+                            debug=debug_trades,
                         )
                     )
-
-                if treatment in [
-                    "deposit",
-                    "withdraw",
-                    "borrow",
-                    "repay",
-                    "full_repay",
-                    "exit",
-                    "liquidation",
-                ]:
-                    vault_id, _ = decustom(transfer["vault_id"])
-
+                elif treatment in LOAN_TREATMENTS:
                     vaddr = vault_id
-
-                if treatment in ["borrow", "repay", "full_repay", "liquidation"]:
                     if vaddr not in loans:
                         loans[vaddr] = Loan(vaddr)
                     loan = loans[vaddr]
@@ -1073,14 +1249,16 @@ class Calculator:
                             token,
                             amount,
                             running_rates,
-                            self.coingecko_rates,
+                            coingecko_rates,
                             fee_amount_per_transaction,
                             exit=treatment == "full_repay",
+                            rate_cache=rate_cache,
+                            debug=debug_trades,
                         )
                         self.interest_payments.extend(interest_payments)
-                        self.ca_transactions.extend(v_trades)
-
-                if treatment in ["deposit", "withdraw", "exit"]:
+                        extend_ca_transactions(v_trades)
+                elif treatment in VAULT_TREATMENTS:
+                    vaddr = vault_id
                     if vaddr not in vaults:
                         vaults[vaddr] = Vault(vaddr, self.vault_gain, self.vault_loss)
 
@@ -1090,37 +1268,44 @@ class Calculator:
                     else:
                         v_trades, v_incomes, v_expenses, _close = vault.withdraw(
                             transaction,
+                            ordered_transfers,
                             trid,
                             token,
                             amount,
                             running_rates,
-                            self.coingecko_rates,
+                            coingecko_rates,
                             usd_fee=fee_amount_per_transaction,
                             exit=treatment == "exit",
+                            rate_cache=rate_cache,
+                            debug=debug_trades,
                         )
-                        self.ca_transactions.extend(v_trades)
+                        extend_ca_transactions(v_trades)
                         self.incomes.extend(v_incomes)
                         log("vault expenses", v_expenses)
                         self.business_expenses.extend(v_expenses)
 
-            del transaction["ordered_transfers"]
-
     def matchup(self):
         queues = {}
         modes = {}
         CA_short = []
         CA_long = []
-        CA_all = []
         errors = {}
+        min_threshold = 0.000001
+        long_term = 365 * 86400
+        flip_errors = {1: (5, "going long"), -1: (3, "going short")}
+        # the FIFO loop below runs for every lot a disposal consumes; don't pay for logging
+        # in it unless it's on
+        debug = current_app.config["DEBUG_LEVEL"] > 0
         log("processing queues")
-        for _idx, ca_trans in enumerate(self.ca_transactions):
+        for ca_trans in self.ca_transactions:
             token = ca_trans.token
+            token_id = token.id
             is_nft = token.nft_id is not None
 
-            if token not in queues:
-                queues[token] = []
+            q = queues.get(token)
+            if q is None:
+                q = queues[token] = deque()
                 modes[token] = 1
-            q = queues[token]
             log("trans", ca_trans, "current q", q)
             mode = modes[token]
 
@@ -1128,11 +1313,12 @@ class Calculator:
             txid = ca_trans.txid
             trid = ca_trans.trid
             done = False
-            min_threshold = 0.000001
             while not done:
                 switch = False
-                if (amount > 0 and mode == 1) or (amount < 0 and mode == -1):
-                    log("put current trans on q")
+                # mode is always 1 or -1, so the amount extends the queue iff it has mode's sign
+                if amount * mode > 0:
+                    if debug:
+                        log("put current trans on q")
                     q.append(ca_trans)
                     done = True
                 else:
@@ -1148,9 +1334,11 @@ class Calculator:
                             or (pos_amount > 0.0001 and rate == 0)
                         )
                     ):
-                        log("qloop")
+                        if debug:
+                            log("qloop")
                         if len(q) == 0:
-                            log("qcase err")
+                            if debug:
+                                log("qcase err")
                             modes[token] = mode = -mode
                             amount = -amount
                             ca_trans.amount = amount
@@ -1160,27 +1348,21 @@ class Calculator:
                             else:
                                 ca_trans.sale = -ca_trans.amount * ca_trans.rate
                             switch = True
-                            if mode == -1:
-                                errors[txid] = {
-                                    "level": 3,
-                                    "error": "going short",
-                                    "amount": amount,
-                                    "token": token.id,
-                                }
-                            else:
-                                errors[txid] = {
-                                    "level": 5,
-                                    "error": "going long",
-                                    "amount": amount,
-                                    "token": token.id,
-                                }
+                            level, error = flip_errors[mode]
+                            errors[txid] = {
+                                "level": level,
+                                "error": error,
+                                "amount": amount,
+                                "token": token_id,
+                            }
                             break
 
                         CA_in = q[0]
 
                         if mode == 1:
                             if CA_in.amount > amount:
-                                log("qcase 1")
+                                if debug:
+                                    log("qcase 1")
                                 prop_in = amount / CA_in.amount
                                 basis_spent_in = CA_in.basis * prop_in
                                 fees_spent_in = CA_in.usd_fee * prop_in
@@ -1189,7 +1371,7 @@ class Calculator:
                                 CA_in.usd_fee -= fees_spent_in
                                 basis = basis_spent_in + fees + fees_spent_in
                                 CA_line = {
-                                    "token": token.id,
+                                    "token": token_id,
                                     "amount": amount,
                                     "in_ts": CA_in.timestamp,
                                     "out_ts": ca_trans.timestamp,
@@ -1204,17 +1386,19 @@ class Calculator:
 
                                 CA_in.amount -= amount
                                 if CA_in.amount * CA_in.rate < min_threshold and CA_in.rate != 0:
-                                    log("del first from q")
-                                    del q[0]
+                                    if debug:
+                                        log("del first from q")
+                                    q.popleft()
                                 amount = 0
                             else:
-                                log("qcase 2")
+                                if debug:
+                                    log("qcase 2")
                                 prop_out = CA_in.amount / amount
                                 fees_spent = fees * prop_out
                                 basis = CA_in.basis + fees_spent + CA_in.usd_fee
                                 fees -= fees_spent
                                 CA_line = {
-                                    "token": token.id,
+                                    "token": token_id,
                                     "amount": CA_in.amount,
                                     "in_ts": CA_in.timestamp,
                                     "out_ts": ca_trans.timestamp,
@@ -1225,13 +1409,15 @@ class Calculator:
                                     "in_txid": CA_in.txid,
                                     "in_trid": CA_in.trid,
                                 }
-                                log("del first from q")
-                                del q[0]
+                                if debug:
+                                    log("del first from q")
+                                q.popleft()
                                 amount -= CA_in.amount
 
                         else:  # short, all amounts negative
                             if CA_in.amount < amount:
-                                log("qcase 3")
+                                if debug:
+                                    log("qcase 3")
                                 prop_in = amount / CA_in.amount
 
                                 sale = CA_in.sale * prop_in
@@ -1241,7 +1427,7 @@ class Calculator:
                                 CA_in.sale -= sale
 
                                 CA_line = {
-                                    "token": token.id,
+                                    "token": token_id,
                                     "amount": -amount,
                                     "out_ts": CA_in.timestamp,
                                     "in_ts": ca_trans.timestamp,
@@ -1258,17 +1444,19 @@ class Calculator:
                                 amount = 0
 
                                 if -CA_in.amount * CA_in.rate < min_threshold and CA_in.rate != 0:
-                                    log("del first from q")
-                                    del q[0]
+                                    if debug:
+                                        log("del first from q")
+                                    q.popleft()
                             else:
-                                log("qcase 4")
+                                if debug:
+                                    log("qcase 4")
                                 prop_out = CA_in.amount / amount
                                 fees_spent = fees * prop_out
                                 sale = CA_in.sale
                                 basis = -CA_in.amount * rate + fees_spent + CA_in.usd_fee
                                 fees -= fees_spent
                                 CA_line = {
-                                    "token": token.id,
+                                    "token": token_id,
                                     "amount": -CA_in.amount,
                                     "out_ts": CA_in.timestamp,
                                     "in_ts": ca_trans.timestamp,
@@ -1279,15 +1467,14 @@ class Calculator:
                                     "out_txid": CA_in.txid,
                                     "out_trid": CA_in.trid,
                                 }
-                                log("del first from q")
-                                del q[0]
+                                if debug:
+                                    log("del first from q")
+                                q.popleft()
                                 amount -= CA_in.amount
 
                         pos_amount = amount * mode
                         CA_line["gain"] = CA_line["sale"] - CA_line["basis"]
-                        # print('cl', pos_amount, amount, CA_line)
-                        CA_all.append(CA_line)
-                        if abs(CA_line["out_ts"] - CA_line["in_ts"]) > 365 * 86400:
+                        if abs(CA_line["out_ts"] - CA_line["in_ts"]) > long_term:
                             CA_long.append(CA_line)
                         else:
                             CA_short.append(CA_line)
@@ -1301,19 +1488,20 @@ class Calculator:
         self.CA_short = CA_short
         self.errors = errors
 
+    def user_path(self):
+        return os.path.join(current_app.instance_path, USER_DIRNAME, self.address)
+
     def cache(self):
         coingecko_rates = self.coingecko_rates
         self.coingecko_rates = None
-        path = os.path.join(current_app.instance_path, USER_DIRNAME)
-        path = os.path.join(path, self.address)
+        path = self.user_path()
         with open(os.path.join(path, "calculator_cache"), "wb") as cache_file:
-            pickle.dump(self, cache_file)
+            pickle.dump(self, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
 
         self.coingecko_rates = coingecko_rates
 
     def from_cache(self):
-        path = os.path.join(current_app.instance_path, USER_DIRNAME)
-        path = os.path.join(path, self.address)
+        path = self.user_path()
         with open(os.path.join(path, "calculator_cache"), "rb") as f:
             C = pickle.load(f)
 
@@ -1355,19 +1543,32 @@ class Calculator:
         rows = []
         total_proceeds = 0
         total_cost = 0
+        year_start, year_end = year_bounds(year)
+
+        # lots consumed by one disposal share its timestamp, format each one once
+        dates = {}
+        symbols = {}
+
+        def date(ts):
+            if ts not in dates:
+                dates[ts] = timestamp_to_date(ts)
+            return dates[ts]
+
         for ca_line in CA:
-            if timestamp_to_year(ca_line["out_ts"]) == year:
-                # symbol = str(ca_line['symbol'].encode("utf-8"))[2:-1]
-                symbol = str(self.tokens[ca_line["token"]].symbol().encode("utf-8"))[2:-1]
-                if len(symbol) == 0:
-                    symbol = "Unknown token: " + self.tokens[ca_line["token"]].symbol(
-                        what_instead=True
-                    )
+            if year_start <= ca_line["out_ts"] < year_end:
+                token_id = ca_line["token"]
+                symbol = symbols.get(token_id)
+                if symbol is None:
+                    token = self.tokens[token_id]
+                    symbol = str(token.symbol().encode("utf-8"))[2:-1]
+                    if len(symbol) == 0:
+                        symbol = "Unknown token: " + token.symbol(what_instead=True)
+                    symbols[token_id] = symbol
                 if format is None:
                     row = [
                         str(ca_line["amount"]) + " units of " + symbol,
-                        timestamp_to_date(ca_line["in_ts"]),
-                        timestamp_to_date(ca_line["out_ts"]),
+                        date(ca_line["in_ts"]),
+                        date(ca_line["out_ts"]),
                         round(ca_line["sale"], 2),
                         round(ca_line["basis"], 2),
                         round(ca_line["gain"], 2),
@@ -1375,9 +1576,9 @@ class Calculator:
                 elif format == "turbotax":
                     row = [
                         symbol,
-                        timestamp_to_date(ca_line["in_ts"]),
+                        date(ca_line["in_ts"]),
                         round(ca_line["basis"], 2),
-                        timestamp_to_date(ca_line["out_ts"]),
+                        date(ca_line["out_ts"]),
                         round(ca_line["sale"], 2),
                     ]
                 rows.append(row)
@@ -1395,8 +1596,7 @@ class Calculator:
 
     def make_turbotax(self, year):
         year = int(year)
-        path = os.path.join(current_app.instance_path, USER_DIRNAME)
-        path = os.path.join(path, self.address)
+        path = self.user_path()
 
         form_8949_short, _short_total_proceeds, _short_total_cost = self.CA_to_form(
             self.CA_short, year, format="turbotax"
@@ -1405,85 +1605,131 @@ class Calculator:
             self.CA_long, year, format="turbotax"
         )
 
-        all_rows = []
-        if form_8949_short:
-            all_rows += form_8949_short
-        if form_8949_long:
-            all_rows += form_8949_long
+        header = ["Currency Name", "Purchase Date", "Cost Basis", "Date Sold", "Proceeds"]
+        row_cnt = len(form_8949_short) + len(form_8949_long)
+        all_rows = itertools.chain(form_8949_short, form_8949_long)
 
-        if len(all_rows) < 4000:  # turbotax limit
+        if row_cnt < 4000:  # turbotax limit
             with open(
                 os.path.join(path, f"turbotax_8949_{year}.csv"), "w", encoding="utf-8"
             ) as form_file:
                 writer = csv.writer(form_file)
-                writer.writerow(
-                    ["Currency Name", "Purchase Date", "Cost Basis", "Date Sold", "Proceeds"]
-                )
+                writer.writerow(header)
                 writer.writerows(all_rows)
             return 0
 
+        # write the batches straight into the archive, they're only downloaded as the zip
         batch_size = 3999
-        batch_cnt = len(all_rows) // batch_size + 1
-        offset = 0
-        file_list = []
-        for batch_idx in range(batch_cnt):
-            file_name = f"turbotax_8949_{year}_batch_{batch_idx + 1}.csv"
-            file_list.append(file_name)
-            with open(os.path.join(path, file_name), "w", encoding="utf-8") as form_file:
-                writer = csv.writer(form_file)
-                writer.writerow(
-                    ["Currency Name", "Purchase Date", "Cost Basis", "Date Sold", "Proceeds"]
-                )
-                writer.writerows(all_rows[offset : offset + batch_size])
-
-            offset += batch_size
-
-        compression = zipfile.ZIP_DEFLATED
-        with zipfile.ZipFile(os.path.join(path, f"turbotax_8949_{year}.zip"), mode="w") as zf:
-            for filename in file_list:
-                zf.write(os.path.join(path, filename), arcname=filename, compress_type=compression)
+        batch_cnt = row_cnt // batch_size + 1
+        with zipfile.ZipFile(
+            os.path.join(path, f"turbotax_8949_{year}.zip"),
+            mode="w",
+            compression=zipfile.ZIP_DEFLATED,
+            compresslevel=ZIP_COMPRESS_LEVEL,
+        ) as zf:
+            for batch_idx in range(batch_cnt):
+                file_name = f"turbotax_8949_{year}_batch_{batch_idx + 1}.csv"
+                with zip_text_file(zf, file_name, newline="") as form_file:
+                    writer = csv.writer(form_file)
+                    writer.writerow(header)
+                    writer.writerows(itertools.islice(all_rows, batch_size))
         return 1
 
     def make_forms(self, year):
         year = int(year)
-        path = os.path.join(current_app.instance_path, USER_DIRNAME)
-        path = os.path.join(path, self.address)
+        path = self.user_path()
 
         form_8949_short, short_total_proceeds, short_total_cost = self.CA_to_form(
             self.CA_short, year
         )
         form_8949_long, long_total_proceeds, long_total_cost = self.CA_to_form(self.CA_long, year)
+        year_start, year_end = year_bounds(year)
+
+        # the forms are only ever downloaded as the archive, write them straight into it
+        zip_path = os.path.join(path, f"tax_forms_{year}.zip")
+        with open(zip_path, "wb", buffering=FORM_BUFFER_SIZE) as zip_file, zipfile.ZipFile(
+            zip_file, mode="w", compression=zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESS_LEVEL
+        ) as zf:
+
+            if not self.mtm:
+                if len(form_8949_short) > 0 or len(form_8949_long) > 0:
+                    with zip_text_file(zf, "form_1040_schedule_D.txt") as form_file:
+                        if short_total_proceeds != 0:
+                            gain = short_total_proceeds - short_total_cost
+                            form_file.write(
+                                f"\nRow 3, column (d): {short_total_proceeds}"
+                                f"\nRow 3, column (e): {short_total_cost}"
+                                f"\nRow 3, column (h): {gain}"
+                                f"\nRow 7, column (h): {gain}"
+                            )
+
+                        if long_total_proceeds != 0:
+                            gain = long_total_proceeds - long_total_cost
+                            form_file.write(
+                                f"\nRow 10, column (d): {long_total_proceeds}"
+                                f"\nRow 10, column (e): {long_total_cost}"
+                                f"\nRow 10, column (h): {gain}"
+                                f"\nRow 15, column (h): {gain}"
+                            )
+
+                        form_file.write(
+                            "\n\nYou will need to complete the rest of the form yourself"
+                        )
+            else:
+                if len(form_8949_short) > 0:
+                    with zip_text_file(zf, "form_4797_part_2.csv") as form_file:
+                        writer = csv.writer(form_file)
+                        writer.writerow(
+                            [
+                                "Description of property",
+                                "Date acquired",
+                                "Date sold or disposed of",
+                                "Proceeds/Gross sales price",
+                                "Cost basis",
+                                "Gain or loss",
+                            ]
+                        )
+                        rows = [
+                            [
+                                "Trader - see attached",
+                                "",
+                                "",
+                                short_total_proceeds,
+                                short_total_cost,
+                                short_total_proceeds - short_total_cost,
+                            ]
+                        ]
+                        writer.writerows(rows)
+
+                    if self.eoy_mtm is not None:
+                        with zip_text_file(
+                            zf, f"mark_to_market_eoy_{year - 1}_holdings.txt"
+                        ) as form_file:
+                            writer = csv.writer(form_file)
+                            writer.writerow(["Description of property"])
+                            rows = []
+                            for token, amount in self.eoy_mtm.items():
+                                contract = token.symbol(what_instead=True)
+                                if "_" in contract:
+                                    contract, _nft_id = contract.split("_")
+                                desc = (
+                                    str(amount)
+                                    + " units of "
+                                    + token.symbol()
+                                    + " ("
+                                    + contract
+                                    + ")"
+                                )
+                                rows.append([desc])
+                            writer.writerows(rows)
 
-        file_list = []
-
-        if not self.mtm:
-            if len(form_8949_short) > 0 or len(form_8949_long) > 0:
-                with open(
-                    os.path.join(path, "form_1040_schedule_D.txt"), "w", encoding="utf-8"
-                ) as form_file:
-                    if short_total_proceeds != 0:
-                        gain = short_total_proceeds - short_total_cost
-                        form_file.write("\nRow 3, column (d): " + str(short_total_proceeds))
-                        form_file.write("\nRow 3, column (e): " + str(short_total_cost))
-                        form_file.write("\nRow 3, column (h): " + str(gain))
-                        form_file.write("\nRow 7, column (h): " + str(gain))
-
-                    if long_total_proceeds != 0:
-                        gain = long_total_proceeds - long_total_cost
-                        form_file.write("\nRow 10, column (d): " + str(long_total_proceeds))
-                        form_file.write("\nRow 10, column (e): " + str(long_total_cost))
-                        form_file.write("\nRow 10, column (h): " + str(gain))
-                        form_file.write("\nRow 15, column (h): " + str(gain))
-
-                    form_file.write("\n\nYou will need to complete the rest of the form yourself")
-
-                file_list.append("form_1040_schedule_D.txt")
-        else:
             if len(form_8949_short) > 0:
-                with open(
-                    os.path.join(path, "form_4797_part_2.csv"), "w", encoding="utf-8"
-                ) as form_file:
-                    file_list.append("form_4797_part_2.csv")
+                if self.mtm:
+                    filename = "form_4797_attachment.csv"
+                else:
+                    filename = "form_8949_part_1.csv"
+
+                with zip_text_file(zf, filename, newline="") as form_file:
                     writer = csv.writer(form_file)
                     writer.writerow(
                         [
@@ -1495,183 +1741,112 @@ class Calculator:
                             "Gain or loss",
                         ]
                     )
-                    rows = [
-                        [
-                            "Trader - see attached",
-                            "",
-                            "",
-                            short_total_proceeds,
-                            short_total_cost,
-                            short_total_proceeds - short_total_cost,
-                        ]
-                    ]
-                    writer.writerows(rows)
-
-                if self.eoy_mtm is not None:
-                    with open(
-                        os.path.join(path, f"mark_to_market_eoy_{year - 1}_holdings.txt"),
-                        "w",
-                        encoding="utf-8",
-                    ) as form_file:
-                        file_list.append("mark_to_market_eoy_" + str(year - 1) + "_holdings.txt")
+                    writer.writerows(form_8949_short)
 
+            if not self.mtm:
+                if len(form_8949_long) > 0:
+                    with zip_text_file(zf, "form_8949_part_2.csv", newline="") as form_file:
                         writer = csv.writer(form_file)
-                        writer.writerow(["Description of property"])
-                        rows = []
-                        for token, amount in self.eoy_mtm.items():
-                            contract = token.symbol(what_instead=True)
-                            if "_" in contract:
-                                contract, _nft_id = contract.split("_")
-                            desc = (
-                                str(amount) + " units of " + token.symbol() + " (" + contract + ")"
-                            )
-                            rows.append([desc])
-                        writer.writerows(rows)
-
-        if len(form_8949_short) > 0:
-            if self.mtm:
-                filename = "form_4797_attachment.csv"
-            else:
-                filename = "form_8949_part_1.csv"
+                        writer.writerow(
+                            [
+                                "Description of property",
+                                "Date acquired",
+                                "Date sold or disposed of",
+                                "Proceeds",
+                                "Cost basis",
+                                "Gain or loss",
+                            ]
+                        )
+                        writer.writerows(form_8949_long)
 
-            with open(os.path.join(path, filename), "w", newline="", encoding="utf-8") as form_file:
-                file_list.append(filename)
-                writer = csv.writer(form_file)
-                writer.writerow(
-                    [
-                        "Description of property",
-                        "Date acquired",
-                        "Date sold or disposed of",
-                        "Proceeds/Gross sales price",
-                        "Cost basis",
-                        "Gain or loss",
-                    ]
-                )
-                writer.writerows(form_8949_short)
-
-        if not self.mtm:
-            if len(form_8949_long) > 0:
-                with open(
-                    os.path.join(path, "form_8949_part_2.csv"), "w", newline="", encoding="utf-8"
-                ) as form_file:
-                    file_list.append("form_8949_part_2.csv")
-                    writer = csv.writer(form_file)
+            log("incomes", self.incomes)
+            if len(self.incomes) > 0:
+                with zip_text_file(zf, "income_list.csv", newline="") as income_list_file:
+                    writer = csv.writer(income_list_file)
                     writer.writerow(
                         [
-                            "Description of property",
-                            "Date acquired",
-                            "Date sold or disposed of",
-                            "Proceeds",
-                            "Cost basis",
-                            "Gain or loss",
+                            (
+                                "This file is for your records. "
+                                "It's a list of all transactions that produced income."
+                            ),
+                            "",
+                            "",
+                            "",
                         ]
                     )
-                    writer.writerows(form_8949_long)
+                    writer.writerow(
+                        ["Timestamp", "Transaction hash", "Description", "Income amount"]
+                    )
 
-        log("incomes", self.incomes)
-        if len(self.incomes) > 0:
-            with open(
-                os.path.join(path, "income_list.csv"), "w", newline="", encoding="utf-8"
-            ) as income_list_file:
-                writer = csv.writer(income_list_file)
-                writer.writerow(
-                    [
-                        (
-                            "This file is for your records. "
-                            "It's a list of all transactions that produced income."
-                        ),
-                        "",
-                        "",
-                        "",
-                    ]
-                )
-                writer.writerow(["Timestamp", "Transaction hash", "Description", "Income amount"])
-
-                income_types = {}
-                for income in self.incomes:
-                    if timestamp_to_year(income["timestamp"]) == year:
-                        income_list_row = [
-                            timestamp_to_date(income["timestamp"], and_time=True),
-                            income["hash"],
-                            income["text"],
-                            income["amount"],
+                    income_types = defaultdict(float)
+                    rows = []
+                    add_row = rows.append
+                    # incomes from one transaction share its timestamp, format each one once
+                    dates = {}
+                    for income in self.incomes:
+                        ts = income["timestamp"]
+                        if year_start <= ts < year_end:
+                            date = dates.get(ts)
+                            if date is None:
+                                date = dates[ts] = timestamp_to_date(ts, and_time=True)
+                            text = income["text"]
+                            amount = income["amount"]
+                            add_row([date, income["hash"], text, amount])
+                            income_types[text] += amount
+                    writer.writerows(rows)
+
+                if len(income_types) > 0:
+                    with zip_text_file(zf, "form_1040_schedule_1.txt") as form_file:
+                        # one line per income type, joined into a single write
+                        lines = [
+                            "\nOnly use this if you DON'T have a registered crypto business. "
+                            "Otherwise use form_1040_schedule_C.txt"
                         ]
-                        writer.writerow(income_list_row)
-
-                        income_type = income["text"]
-                        if income_type not in income_types:
-                            income_types[income_type] = 0
-                        income_types[income_type] += income["amount"]
-
-            file_list.append("income_list.csv")
-
-            if len(income_types) > 0:
-                with open(
-                    os.path.join(path, "form_1040_schedule_1.txt"), "w", encoding="utf-8"
-                ) as form_file:
-                    file_list.append("form_1040_schedule_1.txt")
-                    form_file.write(
-                        "\nOnly use this if you DON'T have a registered crypto business. "
-                        "Otherwise use form_1040_schedule_C.txt"
-                    )
-                    total = 0
-                    for type, amount in income_types.items():
-                        if amount > 0.5:
-                            form_file.write(
-                                "\nRow 8 income type: " + type + ", amount: " + str(round(amount))
-                            )
-                        total += amount
-                    form_file.write("\nRow 8 total: " + str(round(total)))
-
-        log("expenses", self.business_expenses)
-        if self.business_expenses:
-            expense_types = {}
-            for expense in self.business_expenses:
-                if timestamp_to_year(expense["timestamp"]) == year:
-                    expense_type = expense["text"]
-                    if expense_type not in expense_types:
-                        expense_types[expense_type] = 0
-                    expense_types[expense_type] += expense["amount"]
-
-            if len(expense_types) > 0:
-                with open(
-                    os.path.join(path, "form_1040_schedule_C.txt"), "w", encoding="utf-8"
-                ) as schedule_C:
-                    file_list.append("form_1040_schedule_C.txt")
-                    total = 0
-                    for type, amount in expense_types.items():
-                        if amount > 0.5:
-                            schedule_C.write(
-                                "\nPart V row: " + type + ", amount: " + str(round(amount))
-                            )
-                        total += amount
-                    schedule_C.write("\nRows 27a, 48: " + str(round(total)))
-                    schedule_C.write(
-                        "\n\nYou will need to complete the rest of the form yourself. "
-                        "Note that you should only file this if cryptocurrency trading is a "
-                        "substantial part of your daily routine, or if you have a registered "
-                        "business. You may wish to consult with a tax professional about this. "
-                        "You may owe additional self-employment taxes."
+                        for type, amount in income_types.items():
+                            if amount > 0.5:
+                                lines.append(f"\nRow 8 income type: {type}, amount: {amount:.0f}")
+                        total = sum(income_types.values())
+                        lines.append(f"\nRow 8 total: {round(total)}")
+                        form_file.write("".join(lines))
+
+            log("expenses", self.business_expenses)
+            if self.business_expenses:
+                expense_types = defaultdict(float)
+                for expense in self.business_expenses:
+                    if year_start <= expense["timestamp"] < year_end:
+                        expense_types[expense["text"]] += expense["amount"]
+
+                if len(expense_types) > 0:
+                    with zip_text_file(zf, "form_1040_schedule_C.txt") as schedule_C:
+                        lines = []
+                        for type, amount in expense_types.items():
+                            if amount > 0.5:
+                                lines.append(f"\nPart V row: {type}, amount: {amount:.0f}")
+                        total = sum(expense_types.values())
+                        lines.append(f"\nRows 27a, 48: {round(total)}")
+                        lines.append(
+                            "\n\nYou will need to complete the rest of the form yourself. "
+                            "Note that you should only file this if cryptocurrency trading is a "
+                            "substantial part of your daily routine, or if you have a registered "
+                            "business. You may wish to consult with a tax professional about this. "
+                            "You may owe additional self-employment taxes."
+                        )
+                        schedule_C.write("".join(lines))
+
+            if self.interest_payments:
+                with zip_text_file(zf, "form_4952.txt") as form_file:
+                    total = sum(
+                        entry["amount"]
+                        for entry in self.interest_payments
+                        if year_start <= entry["timestamp"] < year_end
                     )
-
-        if self.interest_payments:
-            with open(os.path.join(path, "form_4952.txt"), "w", encoding="utf-8") as form_file:
-                file_list.append("form_4952.txt")
-                total = 0
-                form_file.write(
-                    "\nWe strongly recommend consulting with a tax professional about "
-                    "deducting loan interest\n"
-                )
-                for entry in self.interest_payments:
-                    if timestamp_to_year(entry["timestamp"]) == year:
-                        total += entry["amount"]
-                form_file.write("\nLine 1: " + str(round(total)))
-                form_file.write("\n\nYou will need to complete the rest of the form yourself")
-
-        compression = zipfile.ZIP_DEFLATED
-        with zipfile.ZipFile(os.path.join(path, f"tax_forms_{year}.zip"), mode="w") as zf:
-            for filename in file_list:
-                zf.write(os.path.join(path, filename), arcname=filename, compress_type=compression)
+                    lines = [
+                        "\nWe strongly recommend consulting with a tax professional about "
+                        "deducting loan interest\n",
+                        f"\nLine 1: {round(total)}",
+                        "\n\nYou will need to complete the rest of the form yourself",
+                    ]
+                    form_file.write("".join(lines))
 
     def vaults_json(self):
         js = {}
@@ -1,10 +1,9 @@
+import operator
 import sys
 import time
 import traceback
 from collections import defaultdict
 
-from sortedcontainers import SortedDict
-
 from .category import Category
 from .fiat_rates import Twelve
 from .util import decustom, log, normalize_address
@@ -100,6 +99,16 @@ class Transfer:
         "synthetic",
         "changed",
     ]
+    ALL_GETTER = operator.attrgetter(*ALL_FIELDS)
+
+    # there can be a great many transfers per user, don't give each one a __dict__
+    __slots__ = tuple(ALL_FIELDS) + (
+        "outbound",
+        "custom_treatment",
+        "custom_rate",
+        "custom_vaultid",
+        "derived_data",
+    )
 
     def __init__(
         self,
@@ -130,7 +139,7 @@ class Transfer:
     ):
         if val is None or val == "":
             val = 0
-        if "," in str(val):
+        if isinstance(val, str) and "," in val:
             val = float(val.replace(",", ""))
         if input_len is None:
             input_len = 0
@@ -170,10 +179,7 @@ class Transfer:
         return getattr(self, key)
 
     def to_dict(self):
-        dct = {}
-        for f in Transfer.ALL_FIELDS:
-            dct[f] = self[f]
-        return dct
+        return dict(zip(Transfer.ALL_FIELDS, Transfer.ALL_GETTER(self)))
 
     def __str__(self):
         return str(self.to_dict())
@@ -216,6 +222,10 @@ class Transaction:
         "amount_non_zero",
         "input_non_zero",
     ]
+    # reads all mapped fields off a transfer in one call, in MAPPED_FIELDS order
+    MAPPED_GETTER = operator.attrgetter(*MAPPED_FIELDS)
+    # fr, to, token_contract, input_len, input out of a grouping row
+    CONTRACT_FIELDS = operator.itemgetter(4, 5, 8, 12, 13)
 
     def __init__(
         self,
@@ -267,8 +277,9 @@ class Transaction:
         self.fiat_rate = 1
         self.minimized = None
         self.counter_parties = {}
-        self.transfers = SortedDict()
+        self.transfers = {}
         self.mappings = {}
+        self.mapped_values = []
         self.amounts = {}
         self.in_cnt = 0
         self.out_cnt = 0
@@ -321,21 +332,35 @@ class Transaction:
                 ]
             )
 
-    def finalize(self, coingecko_rates, fiat_rates, signatures, store_derived=False):
-        t_fin = [0, 0, 0, 0, 0]
+    # per-stage timings are only collected, and returned, when profile is set
+    def finalize(self, coingecko_rates, fiat_rates, signatures, store_derived=False, profile=False):
+        t_fin = [0, 0, 0, 0, 0] if profile else []
         self.total_fee = 0
-        self.transfers = SortedDict()
+        self.transfers = {}
+        chain = self.chain
+        chain_name = chain.name
+        is_solana = chain_name == "Solana"
+        transferred_tokens = chain.transferred_tokens
         null_addr = "0x0000000000000000000000000000000000000000"
         counter_parties = {}
         potentates = {}
 
         amounts = defaultdict(float)
+        my_address = self.address_checker()
+        # a transaction's transfers mostly move the same few tokens at the same timestamp,
+        # look each one up once
+        rates_by_id = {}
+        rates_by_contract = {}
+        principals = {}
+        # and pass the same couple of addresses back and forth
+        normalized = {}
         dd = self.derived_data
         use_dd = dd is not None and not store_derived
 
-        self.mappings = {}
-        for key in Transaction.MAPPED_FIELDS:  # .keys():
-            self.mappings[key] = defaultdict(list)
+        # the lookup index is built from these on first use, see build_mappings
+        self.mappings = None
+        mapped_values = self.mapped_values = []
+        mapped_getter = Transaction.MAPPED_GETTER
 
         if store_derived and dd is not None:  # and dd['certainty'] is not None:
             if dd["certainty"] is not None:  # it's not a new transaction
@@ -354,7 +379,8 @@ class Transaction:
             synthetic,
             derived,
         ) in enumerate(self.grouping):
-            t0 = time.time()
+            if profile:
+                t0 = time.perf_counter()
             (
                 hash,
                 ts,
@@ -371,8 +397,12 @@ class Transaction:
                 input_len,
                 input,
             ) = sub_data
-            fr = normalize_address(fr)
-            to = normalize_address(to)
+            if fr not in normalized:
+                normalized[fr] = normalize_address(fr)
+            fr = normalized[fr]
+            if to not in normalized:
+                normalized[to] = normalize_address(to)
+            to = normalized[to]
             self.hash = hash
             self.ts = ts
             if block is not None:
@@ -400,10 +430,15 @@ class Transaction:
                 )  # rate updated on the client
                 coingecko_id = token_contract
             elif coingecko_id is not None:
-                tc0 = time.time()
-                rate_found, rate, rate_source = coingecko_rates.lookup_rate_by_id(coingecko_id, ts)
-                tc1 = time.time()
-                t_fin[3] += tc1 - tc0
+                if profile:
+                    tc0 = time.perf_counter()
+                rate_key = (coingecko_id, ts)
+                if rate_key not in rates_by_id:
+                    rates_by_id[rate_key] = coingecko_rates.lookup_rate_by_id(coingecko_id, ts)
+                rate_found, rate, rate_source = rates_by_id[rate_key]
+                if profile:
+                    tc1 = time.perf_counter()
+                    t_fin[3] += tc1 - tc0
                 log(
                     "Looked up coingecko rate in finalize",
                     hash,
@@ -424,15 +459,21 @@ class Transaction:
                     derived["rate_source"],
                 )
             else:
-                tc2 = time.time()
-                coingecko_id = coingecko_rates.lookup_id(self.chain.name, token_contract)
-                tc3 = time.time()
-                t_fin[4] += tc3 - tc2
-                rate_found, rate, rate_source = coingecko_rates.lookup_rate(
-                    self.chain.name, token_contract, ts
-                )  # can't use custom rates here because they'll get saved into derived data
-            t1 = time.time()
-            t_fin[0] += t1 - t0
+                if profile:
+                    tc2 = time.perf_counter()
+                rate_key = (token_contract, ts)
+                if rate_key not in rates_by_contract:
+                    rates_by_contract[rate_key] = (
+                        coingecko_rates.lookup_id(chain_name, token_contract),
+                        coingecko_rates.lookup_rate(chain_name, token_contract, ts),
+                    )  # can't use custom rates here because they'll get saved into derived data
+                coingecko_id, (rate_found, rate, rate_source) = rates_by_contract[rate_key]
+                if profile:
+                    tc3 = time.perf_counter()
+                    t_fin[4] += tc3 - tc2
+            if profile:
+                t1 = time.perf_counter()
+                t_fin[0] += t1 - t0
 
             _decustomed_input, is_custom_op = decustom(input)
             if not is_custom_op:
@@ -442,17 +483,21 @@ class Transaction:
 
             self_transfer = False
             skip_transfer_cps = False
-            from_me = self.my_address(fr)
-            to_me = self.my_address(to)
+            from_me = my_address(fr)
+            to_me = my_address(to)
             if from_me and to_me:
                 skip_transfer_cps = True
 
-            from_me_strict = self.my_address(fr, strict=True)
-            to_me_strict = self.my_address(to, strict=True)
+            from_me_strict = my_address(fr, strict=True)
+            to_me_strict = my_address(to, strict=True)
             if from_me_strict and to_me_strict:
                 self_transfer = True
 
-            principal = coingecko_rates.lookup_principal(self.chain.name, token_contract)
+            if token_contract not in principals:
+                principals[token_contract] = coingecko_rates.lookup_principal(
+                    chain_name, token_contract
+                )
+            principal = principals[token_contract]
 
             transfer = Transfer(
                 id,
@@ -478,8 +523,9 @@ class Transaction:
                 synthetic=synthetic,
                 principal=principal,
             )
-            t2 = time.time()
-            t_fin[1] += t2 - t1
+            if profile:
+                t2 = time.perf_counter()
+                t_fin[1] += t2 - t1
 
             if use_dd:
                 transfer.derived_data = derived
@@ -507,19 +553,16 @@ class Transaction:
                 Transfer.FEE,
                 self_transfer,
                 dd is None,
-                self.chain,
+                chain,
             )
 
             if transfer.synthetic != Transfer.FEE:  # mostly ignore fee transfer
                 if (
-                    self.chain.name == "Solana"
-                    and transfer.what == "SOL"
-                    and transfer.amount < 0.03
+                    is_solana and transfer.what == "SOL" and transfer.amount < 0.03
                 ):  # ignore SOL dust
                     pass
                 else:
-                    for key in Transaction.MAPPED_FIELDS:
-                        self.mappings[key][transfer[key]].append(id)
+                    mapped_values.append((id, mapped_getter(transfer)))
 
                     if not self_transfer:
                         if val != 0:
@@ -531,19 +574,19 @@ class Transaction:
 
                 if not skip_transfer_cps:
                     if not use_dd:
-                        if self.chain.name != "Solana":
+                        if not is_solana:
                             for addr in [
                                 fr,
                                 to,
                             ]:  # gather potential counterparties from transfer to/from addresses,
                                 # superceeded later by self.interacted -- the contract address
                                 if (
-                                    not self.my_address(addr)
+                                    not my_address(addr)
                                     and addr != null_addr
                                     and addr[:2].lower() == "0x"
-                                    and addr not in self.chain.transferred_tokens
+                                    and addr not in transferred_tokens
                                 ):
-                                    prog_name, prog_addr = self.chain.get_progenitor_entity(addr)
+                                    prog_name, prog_addr = chain.get_progenitor_entity(addr)
                                     if prog_addr is None or prog_addr == "None":
                                         prog_addr = addr
 
@@ -552,7 +595,7 @@ class Transaction:
                                     if prog_name is not None:
                                         potentates[prog_addr] = [prog_name, None, None, 1, addr]
 
-                    if self.chain.name == "Solana" and input_len == 200:  # input is nft address
+                    if is_solana and input_len == 200:  # input is nft address
                         transfer.input = input
                         log("setting input to", input)
 
@@ -560,10 +603,16 @@ class Transaction:
                 self.total_fee = transfer.amount
                 self.fee_transfer = transfer
                 self.originator = transfer.fr
-            t3 = time.time()
-            t_fin[2] += t3 - t2
+            if profile:
+                t3 = time.perf_counter()
+                t_fin[2] += t3 - t2
+
+        # everything downstream walks transfers in id order; the grouping mostly arrives in it
+        # already, so one sort here is cheaper than a sorted container taking every insert
+        self.transfers = dict(sorted(self.transfers.items()))
 
-        tt0 = time.time()
+        if profile:
+            tt0 = time.perf_counter()
         if use_dd:
             if dd["cp_progenitor"] is not None:
                 counter_parties[dd["cp_progenitor"]] = [
@@ -634,8 +683,9 @@ class Transaction:
                 counter_parties[prog_addr] = [prog_name, sig, decoded_sig, 1, prog_addr]
             else:
                 counter_parties = potentates
-        tt1 = time.time()
-        t_fin.append(tt1 - tt0)
+        if profile:
+            tt1 = time.perf_counter()
+            t_fin.append(tt1 - tt0)
 
         if len(counter_parties) > 1:  # remove unknowns
             new_cps = {}
@@ -657,33 +707,34 @@ class Transaction:
             transfer.set_default_vaultid(cp_name)
 
         self.amounts = dict(amounts)
-
-        out_cnt = 0
-        in_cnt = 0
-        for _k, v in self.amounts.items():
-            if v > 0:
-                in_cnt += 1
-            if v < 0:
-                out_cnt += 1
-        self.in_cnt = in_cnt
-        self.out_cnt = out_cnt
-        tt2 = time.time()
-        t_fin.append(tt2 - tt1)
+        self.in_cnt = sum(v > 0 for v in self.amounts.values())
+        self.out_cnt = sum(v < 0 for v in self.amounts.values())
+        if profile:
+            tt2 = time.perf_counter()
+            t_fin.append(tt2 - tt1)
         return t_fin
 
+    def build_mappings(self):
+        # indexes the field values snapshotted in finalize, so later rate inference doesn't
+        # move transfers between buckets
+        self.mappings = {}
+        for key in Transaction.MAPPED_FIELDS:
+            self.mappings[key] = defaultdict(list)
+        field_mappings = [self.mappings[key] for key in Transaction.MAPPED_FIELDS]
+        for id, values in self.mapped_values:
+            for mapping, value in zip(field_mappings, values):
+                mapping[value].append(id)
+
     # finds all matching transfers by a dictionary of AND-ed field=value pairs
     def lookup(self, fv_pairs, count_only=False):
+        if self.mappings is None:
+            self.build_mappings()
         matching_ids = None
         for field, value in fv_pairs.items():
             assert field in Transaction.MAPPED_FIELDS
             mapping = self.mappings[field]
             if isinstance(value, (list, set)):  # find everyone that's in the list
-                subset = set()
-                value_list = value
-
-                for val in mapping.keys():
-                    if val in value_list:
-                        subset = subset.union(mapping[val])
+                subset = set().union(*(mapping[val] for val in value if val in mapping))
                 if matching_ids is None:
                     matching_ids = subset
                 else:
@@ -720,42 +771,42 @@ class Transaction:
     def my_address(self, address, strict=False):
         return self.user.check_user_address(self.chain.name, address, strict=strict)
 
+    def address_checker(self):
+        # the same few addresses recur across a transaction's transfers, check each one once
+        checked = {}
+
+        def my_address(address, strict=False):
+            key = (address, strict)
+            if key not in checked:
+                checked[key] = self.my_address(address, strict=strict)
+            return checked[key]
+
+        return my_address
+
     def get_contracts(self):
         contract_list = set()
         counterparty_list = set()
         input_list = set()
+        my_address = self.address_checker()
+        is_solana = self.chain.name == "Solana"
 
-        for _type, sub_data, _, _, _, _, _, _ in self.grouping:
-            (
-                _hash,
-                _ts,
-                _nonce,
-                _block,
-                fr,
-                to,
-                _val,
-                _token,
-                token_contract,
-                _coingecko_id,
-                _token_nft_id,
-                _base_fee,
-                input_len,
-                input,
-            ) = sub_data
+        contract_fields = Transaction.CONTRACT_FIELDS
+        for entry in self.grouping:
+            fr, to, token_contract, input_len, input = contract_fields(entry[1])
             if token_contract is not None:
                 contract_list.add(token_contract)
-            if self.chain.name != "Solana":
+            if not is_solana:
                 if input_len is not None and input_len > 2:  # ignore 0x
                     if input is not None:
                         input_list.add(input)
 
                 # it's possible we don't have the transfer that called the contract
-                if not self.my_address(to):
+                if not my_address(to):
                     counterparty_list.add(to)
 
-                if not self.my_address(fr):
+                if not my_address(fr):
                     counterparty_list.add(fr)
-            if self.chain.name == "Solana":
+            if is_solana:
                 if self.interacted is not None:
                     counterparty_list = [self.interacted]
                 if self.function is not None:
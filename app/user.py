@@ -60,7 +60,8 @@ class User:
         if not os.path.exists(self.db_uri):
             first_run = True
         self.first_run = first_run
-        self.db = SQLite(f"users/{address}/db", do_logging=self.sql_logging)
+        # backups copy db.db and reloads check its mtime, so keep every commit in that one file
+        self.db = SQLite(f"users/{address}/db", do_logging=self.sql_logging, wal=False)
 
         drop = False
         if first_run:
@@ -2406,10 +2407,11 @@ class User:
         self.prepare_all_custom_types()
         classifier = Classifier()
         t_fin_all = None
+        profile = current_app.config["DEBUG_LEVEL"] > 0
         for idx, transaction in enumerate(transactions):
             t1 = time.time()
             t_fin = transaction.finalize(
-                coingecko_rates, self.fiat_rates, signatures, store_derived
+                coingecko_rates, self.fiat_rates, signatures, store_derived, profile=profile
             )
             if t_fin_all is None:
                 t_fin_all = t_fin
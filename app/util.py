@@ -175,14 +175,9 @@ def log_error(*args: Any) -> None:
 
 
 def decustom(val: Optional[str]) -> tuple[Optional[str], bool]:
-    custom = False
-    try:
-        if val is not None and val[:7] == "custom:":
-            val = val[7:]
-            custom = True
-        return val, custom
-    except (TypeError, ValueError):
-        return val, custom
+    if isinstance(val, str) and val.startswith("custom:"):
+        return val[7:], True
+    return val, False
 
 
 def sql_in(lst: Any) -> str:
@@ -31,6 +31,10 @@ class Config:  # pylint: disable=too-few-public-methods
     _mail_alerts_raw = os.environ.get("MAIL_ALERTS", "")
     MAIL_ALERTS = [email.strip() for email in _mail_alerts_raw.split(",") if email.strip()]
 
+    # transaction hashes to dump while calculating taxes
+    _debug_hashes_raw = os.environ.get("DEFITAXES_DEBUG_HASHES", "")
+    DEBUG_HASHES = frozenset(h.strip() for h in _debug_hashes_raw.split(",") if h.strip())
+
 
 class DevelopmentConfig(Config):  # pylint: disable=too-few-public-methods
     DEBUG_LEVEL = 1
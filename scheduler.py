@@ -19,12 +19,14 @@ from flask import Flask
 
 from app.coingecko import CoinGecko
 from app.constants import APP_NAME
+from app.sqlite import close_all as close_sqlite_connections
 from config import config
 
 
 def _create_app(config_name: str, instance_path: Optional[str]) -> Flask:
     app = Flask(__name__, instance_path=instance_path)
     app.config.from_object(config[config_name])
+    app.teardown_appcontext(close_sqlite_connections)
     return app
 
 